@@ -0,0 +1,143 @@
+'''
+HTTP/2 capable stand-in for the Control API (Python 3, requires hypercorn).
+
+Serves the same MockApi as bench.mock_server as an ASGI app, speaking
+HTTP/1.1 and cleartext HTTP/2 (h2c with prior knowledge) on one port, so
+both transports can be compared against the same server. Delays are
+awaited, so slow responses on one connection do not hold up the others.
+'''
+import asyncio
+import multiprocessing
+import os
+import socket
+import threading
+
+try:
+	from hypercorn.asyncio import serve
+	from hypercorn.config import Config
+except ImportError:
+	serve = None
+
+from bench.mock_server import MockApi, Options
+
+
+class App(object):
+	def __init__(self, api):
+		self.api = api
+		self.connections = set()
+		self.versions = {}
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http':
+			return
+		self.connections.add(scope['client'])
+		self.versions[scope['http_version']] = self.versions.get(scope['http_version'], 0) + 1
+		body = b''
+		while True:
+			message = await receive()
+			body += message.get('body', b'')
+			if not message.get('more_body'):
+				break
+		path = scope['raw_path'].decode('latin-1')
+		if scope['query_string']:
+			path += '?' + scope['query_string'].decode('latin-1')
+		headers = dict((name.decode('latin-1').lower(), value.decode('latin-1')) for name, value in scope['headers'])
+		delay, status, headers, body = self.api.handle(scope['method'], path, headers, body)
+		if delay:
+			await asyncio.sleep(delay)
+		headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+		headers.append((b'content-length', str(len(body)).encode('latin-1')))
+		await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+		await send({'type': 'http.response.body', 'body': body})
+
+
+def _serve(sock, options, conn):
+	api = MockApi(options)
+	app = App(api)
+	config = Config()
+	# hypercorn closes the socket it serves on, so it gets a duplicate
+	config.bind = ['fd://%d' % os.dup(sock.fileno())]
+	config.keep_alive_timeout = 60
+	# hypercorn sends GOAWAY after 1000 requests by default, which fails
+	# the requests in flight on the connection
+	config.keep_alive_max_requests = 10 ** 9
+	config.accesslog = None
+	config.errorlog = None
+	loop = asyncio.new_event_loop()
+	stopped = asyncio.Event()
+
+	def wait_for_stop():
+		conn.recv()
+		loop.call_soon_threadsafe(stopped.set)
+
+	thread = threading.Thread(target=wait_for_stop)
+	thread.daemon = True
+	thread.start()
+	loop.call_soon(conn.send, 'started')
+	loop.run_until_complete(serve(app, config, shutdown_trigger=stopped.wait))
+	loop.close()
+	conn.send({'connections': len(app.connections), 'versions': app.versions, 'stats': api.stats})
+
+
+class H2MockServer(object):
+	'''
+	Runs the stand-in in a child process, so the client under test does not
+	share the interpreter lock with it, with the interface of
+	bench.mock_server.MockServer except that the MockApi is not reachable:
+	stop() returns the connections seen, the requests per HTTP version and
+	the MockApi stats, and keeps them in counts.
+	'''
+	def __init__(self, options=None, port=0):
+		if serve is None:
+			raise ImportError('H2MockServer requires hypercorn')
+		self.options = options or Options()
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.socket.bind(('127.0.0.1', port))
+		self.socket.listen(1024)
+		self.process = None
+		self.conn = None
+		self.counts = None
+
+	def url(self):
+		return 'http://127.0.0.1:%d/v1/' % self.socket.getsockname()[1]
+
+	def auth_domain(self):
+		return 'http://127.0.0.1:%d' % self.socket.getsockname()[1]
+
+	def start(self):
+		self.conn, child = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=_serve, args=(self.socket, self.options, child))
+		self.process.daemon = True
+		self.process.start()
+		self.conn.recv()
+		return self
+
+	def stop(self):
+		self.conn.send('stop')
+		self.counts = self.conn.recv()
+		self.process.join(5)
+		self.socket.close()
+		return self.counts
+
+
+if __name__ == '__main__':
+	import argparse
+	import time
+
+	parser = argparse.ArgumentParser(description='Run the HTTP/2 capable mock Control API and auth server.')
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API request')
+	parser.add_argument('--jitter', type=float, default=0.0)
+	parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of API requests answered with 503')
+	parser.add_argument('--collections', type=int, default=0)
+	parser.add_argument('--inputs', type=int, default=0)
+	args = parser.parse_args()
+
+	server = H2MockServer(Options(args.latency, args.jitter, args.error_rate, args.collections, args.inputs), args.port).start()
+	print('Serving %s (HTTP/1.1 and h2c)' % server.url())
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		print(server.stop())
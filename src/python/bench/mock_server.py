@@ -0,0 +1,264 @@
+'''
+Local stand-in for the Control API and the Frigg auth server, used by the
+benchmarks.
+
+Emulates the collection, filter and publication resources (list with
+skip/limit and collectionId filtering, ETag/304, get, create including
+list payloads, patch, batch delete) and /oauth/token, /oauth/token/info.
+Latency, error rate and the preloaded dataset are configurable.
+'''
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+
+try:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+	from SocketServer import ThreadingMixIn
+	from urlparse import urlsplit, parse_qs
+except ImportError:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+	from socketserver import ThreadingMixIn
+	from urllib.parse import urlsplit, parse_qs
+
+resources = (
+	'collection/collections',
+	'collection/inputs',
+	'filter/chains',
+	'filter/sets',
+	'filter/lists',
+	'publication/publications',
+	'publication/customizations'
+)
+
+services = (('twitter', 'keyword'), ('instagram', 'tag'), ('flickr', 'tag'), ('youtube', 'keyword'), ('tumblr', 'tag'), ('vk', 'tag'))
+
+
+class Options(object):
+	def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, collections=0, inputs=0, token_ttl=3600000, expires_in=True, auth_latency=0.0):
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.collections = collections
+		self.inputs = inputs
+		self.token_ttl = token_ttl
+		self.expires_in = expires_in
+		self.auth_latency = auth_latency
+
+
+class MockApi(object):
+	def __init__(self, options):
+		self.options = options
+		self.lock = threading.Lock()
+		self.data = dict((resource, {}) for resource in resources)
+		self.order = dict((resource, []) for resource in resources)
+		self.versions = dict((resource, 0) for resource in resources)
+		self.stats = {'requests': 0, 'errors': 0, 'token_requests': 0, 'info_requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+		self.tokens = 0
+		self.preload()
+
+	def preload(self):
+		collections = [self.create('collection/collections', {'name': 'topic%d' % i, 'contractId': 'bench', 'active': True})
+			for i in range(self.options.collections)]
+		for i in range(self.options.inputs if collections else 0):
+			service, type = services[i % len(services)]
+			self.create('collection/inputs', {
+				'collectionId': collections[i % len(collections)]['_id'],
+				'contractId': 'bench',
+				'service': service,
+				'type': type,
+				'input': 'keyword%d' % (i // len(services)),
+				'display': True,
+				'active': True
+			})
+
+	def create(self, resource, item):
+		item = dict(item, _id=uuid.uuid4().hex)
+		with self.lock:
+			self.data[resource][item['_id']] = item
+			self.order[resource].append(item['_id'])
+			self.versions[resource] += 1
+		return item
+
+	def listing(self, resource, query):
+		with self.lock:
+			items = [self.data[resource][i] for i in self.order[resource] if i in self.data[resource]]
+			version = self.versions[resource]
+		if 'collectionId' in query:
+			items = [item for item in items if item.get('collectionId') == query['collectionId'][0]]
+		if 'skip' in query or 'limit' in query:
+			skip = int(query.get('skip', ['0'])[0])
+			limit = int(query.get('limit', [str(len(items))])[0])
+			items = items[skip:skip + limit]
+		return items, version
+
+	def delete(self, resource, ids):
+		with self.lock:
+			for i in ids:
+				self.data[resource].pop(i, None)
+			self.order[resource] = [i for i in self.order[resource] if i in self.data[resource]]
+			self.versions[resource] += 1
+
+	def patch(self, resource, i, changes):
+		with self.lock:
+			item = self.data[resource].get(i)
+			if item is None:
+				return None
+			item.update(changes)
+			self.versions[resource] += 1
+			return item
+
+	def count(self, key, n=1):
+		with self.lock:
+			self.stats[key] += n
+
+	def delay(self, latency):
+		options = self.options
+		wait = latency + (random.uniform(-options.jitter, options.jitter) if options.jitter else 0)
+		return max(wait, 0)
+
+	def handle(self, method, path, headers, body):
+		'''
+		Answers one request independently of the HTTP server. headers is a
+		dict with lower case names; returns (delay, status, headers, body),
+		delay being the seconds to wait before responding.
+		'''
+		self.count('bytes_in', len(body))
+		parts = urlsplit(path)
+		segments = [s for s in parts.path.split('/') if s][1:]
+		query = parse_qs(parts.query)
+		if segments == ['oauth', 'token'] and method == 'POST':
+			return self.token()
+		if segments == ['oauth', 'token', 'info'] and method == 'GET':
+			return self.token_info()
+		self.count('requests')
+		delay = self.delay(self.options.latency)
+		if self.options.error_rate and random.random() < self.options.error_rate:
+			self.count('errors')
+			return self.respond(delay, 503, {'error': 'unavailable'}, {'Retry-After': '0'})
+		resource = '/'.join(segments[:2])
+		if resource not in resources:
+			return self.respond(delay, 404, {'error': 'not found'})
+		i = segments[2] if len(segments) > 2 else None
+		if method == 'GET':
+			if i:
+				item = self.data[resource].get(i)
+				return self.respond(delay, 200 if item else 404, item)
+			items, version = self.listing(resource, query)
+			etag = '"%s-%d-%d"' % (resource.replace('/', '-'), version, len(items))
+			if headers.get('if-none-match') == etag:
+				return delay, 304, {'ETag': etag}, b''
+			return self.respond(delay, 200, items, {'ETag': etag})
+		if method == 'POST':
+			data = json.loads(body.decode('utf-8'))
+			if isinstance(data, list):
+				return self.respond(delay, 200, [self.create(resource, item) for item in data])
+			return self.respond(delay, 200, self.create(resource, data))
+		if method == 'PATCH':
+			item = self.patch(resource, i, json.loads(body.decode('utf-8')))
+			return self.respond(delay, 200 if item else 404, item)
+		if method == 'DELETE':
+			ids = json.loads(body.decode('utf-8')).get('ids', []) if body else [i]
+			self.delete(resource, ids)
+			return delay, 204, {}, b''
+		return self.respond(delay, 405, {'error': 'method not allowed'})
+
+	def respond(self, delay, status, obj, headers=None):
+		body = json.dumps(obj).encode('utf-8') if obj is not None else b''
+		headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+		self.count('bytes_out', len(body))
+		return delay, status, headers, body
+
+	def token(self):
+		self.count('token_requests')
+		with self.lock:
+			self.tokens += 1
+			n = self.tokens
+		data = {'access_token': 'access%d' % n, 'refresh_token': 'refresh%d' % n}
+		if self.options.expires_in:
+			data['expires_in'] = self.options.token_ttl // 1000
+		return self.respond(self.delay(self.options.auth_latency), 200, data)
+
+	def token_info(self):
+		self.count('info_requests')
+		return self.respond(self.delay(self.options.auth_latency), 200, {'ttl': self.options.token_ttl})
+
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+		# headers and body go out in separate writes
+		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def log_message(self, format, *args):
+		pass
+
+	def dispatch(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		body = self.rfile.read(length) if length else b''
+		headers = dict((name.lower(), value) for name, value in self.headers.items())
+		delay, status, headers, body = self.server.api.handle(self.command, self.path, headers, body)
+		if delay:
+			time.sleep(delay)
+		self.send_response(status)
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	do_GET = do_POST = do_PATCH = do_DELETE = dispatch
+
+
+class Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+class MockServer(object):
+	'''
+	Runs the stand-in on a background thread. url is the API base url
+	(ending in /v1/), auth_domain the Frigg authServerDomain.
+	'''
+	def __init__(self, options=None, port=0):
+		self.api = MockApi(options or Options())
+		self.server = Server(('127.0.0.1', port), Handler)
+		self.server.api = self.api
+		self.thread = None
+
+	def url(self):
+		return 'http://127.0.0.1:%d/v1/' % self.server.server_address[1]
+
+	def auth_domain(self):
+		return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Run the mock Control API and auth server.')
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API request')
+	parser.add_argument('--jitter', type=float, default=0.0)
+	parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of API requests answered with 503')
+	parser.add_argument('--collections', type=int, default=0)
+	parser.add_argument('--inputs', type=int, default=0)
+	args = parser.parse_args()
+
+	server = MockServer(Options(args.latency, args.jitter, args.error_rate, args.collections, args.inputs), args.port)
+	print('Serving %s' % server.url())
+	server.server.serve_forever()
@@ -0,0 +1,360 @@
+'''
+Benchmarks of the Control API client against the local mock server.
+
+Run from src/python:
+
+	python -m bench.run [scenario ...] [--latency 0.005] [--json]
+
+Every scenario runs in its own process with its own mock server, so the
+peak RSS reported for one scenario is not inflated by the ones before it.
+The mock server shares that process: rss_growth, the peak RSS minus the RSS
+before the measured section, is the better figure for comparing runs.
+
+The multiplex scenarios compare the HTTP/1.1 and HTTP/2 transports against
+bench.h2_server and need Python 3 with hypercorn and httpx[http2].
+'''
+from __future__ import print_function
+
+import json
+import logging
+import multiprocessing
+import resource
+import threading
+import time
+
+import controlapi.bulk as bulk
+import controlapi.client as client
+import controlapi.codec as codec
+import controlapi.json_http as http
+import controlapi.reconcile as reconcile
+from frigg.frigg import Frigg
+
+from bench.mock_server import MockServer, Options, services
+
+logger = logging.getLogger(__name__)
+
+
+class Recorder(object):
+	'''
+	Collects the per request fields reported by json_http.Transport.
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.samples = []
+
+	def __call__(self, fields):
+		with self.lock:
+			self.samples.append(fields)
+
+
+def percentile(values, p):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def rss():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def result(name, wall, latencies, bytes, rss_before, **extra):
+	fields = {
+		'scenario': name,
+		'wall': wall,
+		'requests': len(latencies),
+		'requests_per_sec': len(latencies) / wall if wall else 0.0,
+		'p50_ms': percentile(latencies, 50) * 1000,
+		'p99_ms': percentile(latencies, 99) * 1000,
+		'bytes': bytes,
+		'peak_rss_kb': rss(),
+		'rss_growth_kb': rss() - rss_before
+	}
+	fields.update(extra)
+	return fields
+
+
+def transport_result(name, wall, recorder, rss_before, **extra):
+	samples = recorder.samples
+	return result(
+		name, wall,
+		[s['elapsed'] for s in samples],
+		sum(s['request_bytes'] + s['response_bytes'] for s in samples),
+		rss_before,
+		**extra
+	)
+
+
+def frigg_config(server, **options):
+	config = {
+		'clientId': 'bench',
+		'clientSecret': 'secret',
+		'authServerDomain': server.auth_domain(),
+		'authServerVersion': 'v1'
+	}
+	config.update(options)
+	return config
+
+
+def make_control(server, args, recorder):
+	transport = http.Transport(pool_maxsize=max(args.concurrency, 1), recorder=recorder, codec=codec.get_codec(args.codec))
+	return client.Control(server.url(), Frigg(frigg_config(server)), 'bench', transport)
+
+
+def topics_config(topics, keywords):
+	return {
+		'services': dict(services),
+		'topics': dict(('topic%d' % t, ['keyword%d' % k for k in range(keywords)]) for t in range(topics))
+	}
+
+
+def seed(api, config, overlap):
+	'''
+	Creates the collections of the first overlap fraction of the topics, with
+	half of their inputs and as many stale ones.
+	'''
+	topics = sorted(config['topics'])
+	for topic in topics[:int(len(topics) * overlap)]:
+		collection = api.create('collection/collections', {'name': topic, 'contractId': 'bench', 'active': True})
+		keys = sorted(reconcile.desired_keys(config['services'], config['topics'][topic]))
+		stale = [(service, type, 'stale' + input) for service, type, input in keys[::2]]
+		for service, type, input in keys[::2] + stale:
+			api.create('collection/inputs', {
+				'collectionId': collection['_id'],
+				'contractId': 'bench',
+				'service': service,
+				'type': type,
+				'input': input,
+				'active': True
+			})
+
+
+def sync(args):
+	'''
+	Full topics sync as done by update_topics.py: snapshot collections and
+	inputs, plan, execute.
+	'''
+	server = MockServer(Options(args.latency, args.jitter, args.error_rate)).start()
+	config = topics_config(args.topics, args.keywords)
+	seed(server.api, config, args.overlap)
+	recorder = Recorder()
+	control = make_control(server, args, recorder)
+	control.token()
+	before = rss()
+	start = time.time()
+	collections = client.CollectionFactory(control).snapshot()
+	inputs = client.InputFactory(control).snapshot()
+	plan = reconcile.plan(config, collections, inputs)
+	outcome = plan.execute(collections, inputs, args.concurrency)
+	wall = time.time() - start
+	server.stop()
+	return [transport_result('sync', wall, recorder, before, ok=outcome.ok(), changes=plan.summary(), server_errors=server.api.stats['errors'])]
+
+
+listings = {
+	'list': lambda factory, args: len(factory.list()),
+	'iter': lambda factory, args: sum(1 for item in factory.iter(args.page_size)),
+	'columns': lambda factory, args: len(factory.columns(page_size=args.page_size))
+}
+
+
+def listing(variant):
+	'''
+	Lists a large inputs collection whole, streamed in pages or as columns.
+	'''
+	def scenario(args):
+		server = MockServer(Options(args.latency, args.jitter, args.error_rate, args.collections, args.inputs)).start()
+		recorder = Recorder()
+		control = make_control(server, args, recorder)
+		control.token()
+		factory = client.InputFactory(control)
+		before = rss()
+		start = time.time()
+		count = listings[variant](factory, args)
+		wall = time.time() - start
+		server.stop()
+		return [transport_result('listing.' + variant, wall, recorder, before, items=count, items_per_sec=count / wall if wall else 0.0)]
+	return scenario
+
+
+def token(args):
+	'''
+	Calls Frigg.token() from many threads while short lived tokens expire,
+	so background and inline refreshes happen during the run.
+	'''
+	server = MockServer(Options(token_ttl=args.token_ttl, auth_latency=args.latency)).start()
+	frigg = Frigg(frigg_config(server, expirationOffset=args.token_ttl // 3, refreshLead=args.token_ttl // 6))
+	frigg.token()
+	latencies = []
+	lock = threading.Lock()
+	deadline = time.time() + args.duration
+
+	def call():
+		own = []
+		while time.time() < deadline:
+			start = time.time()
+			frigg.token()
+			own.append(time.time() - start)
+		with lock:
+			latencies.extend(own)
+
+	before = rss()
+	start = time.time()
+	threads = [threading.Thread(target=call) for i in range(args.threads)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	wall = time.time() - start
+	frigg.close()
+	server.stop()
+	stats = server.api.stats
+	return [result('token', wall, latencies, stats['bytes_in'] + stats['bytes_out'], before,
+		token_requests=stats['token_requests'], info_requests=stats['info_requests'])]
+
+
+def codecs(args):
+	'''
+	Decodes and encodes a large inputs listing with every installed codec,
+	without HTTP, to isolate the JSON cost.
+	'''
+	server = MockServer(Options(collections=args.collections, inputs=args.inputs))
+	items, version = server.api.listing('collection/inputs', {})
+	server.server.server_close()
+	body = codec.get_codec('json').dumps(items)
+	results = []
+	for name in codec.available():
+		backend = codec.get_codec(name)
+		before = rss()
+		latencies = []
+		start = time.time()
+		for i in range(args.repeat):
+			decode = time.time()
+			backend.loads(body)
+			latencies.append(time.time() - decode)
+		encode = time.time()
+		for i in range(args.repeat):
+			backend.dumps(items)
+		encoded = time.time() - encode
+		wall = time.time() - start
+		decoded = sum(latencies)
+		results.append(result('codec.' + name, wall, latencies, len(body) * args.repeat, before,
+			decode_mb_per_sec=len(body) * args.repeat / decoded / 1e6,
+			encode_mb_per_sec=len(body) * args.repeat / encoded / 1e6))
+	return results
+
+
+def multiplex(protocol):
+	'''
+	Creates many collections with high concurrency against the HTTP/2
+	capable stand-in, over HTTP/1.1 with one pooled connection per request
+	in flight, or over HTTP/2 streams sharing --connections connections.
+	'''
+	def scenario(args):
+		import controlapi.http2 as http2
+		from bench.h2_server import H2MockServer
+		server = H2MockServer(Options(args.latency, args.jitter, args.error_rate)).start()
+		recorder = Recorder()
+		if protocol == 'http2':
+			transport = http2.Http2Transport(max_connections=args.connections, http1=False, recorder=recorder, codec=codec.get_codec(args.codec))
+		else:
+			transport = http.Transport(pool_maxsize=max(args.multiplex_concurrency, 1), recorder=recorder, codec=codec.get_codec(args.codec))
+		frigg = Frigg(frigg_config(server))
+		control = client.Control(server.url(), frigg, 'bench', transport)
+		control.token()
+		items = [{'name': 'topic%d' % i, 'contractId': 'bench', 'active': True} for i in range(args.requests)]
+		before = rss()
+		start = time.time()
+		report = bulk.run(lambda item: control.post('collection/collections', item), items, args.multiplex_concurrency)
+		wall = time.time() - start
+		transport.close()
+		frigg.close()
+		counts = server.stop()
+		return [transport_result('multiplex.' + protocol, wall, recorder, before, ok=report.ok(),
+			connections=counts['connections'], http_versions=counts['versions'])]
+	return scenario
+
+
+scenarios = {
+	'codec': codecs,
+	'multiplex.http1': multiplex('http1'),
+	'multiplex.http2': multiplex('http2'),
+	'sync': sync,
+	'listing.list': listing('list'),
+	'listing.iter': listing('iter'),
+	'listing.columns': listing('columns'),
+	'token': token
+}
+
+
+def _run(name, args, queue):
+	try:
+		queue.put(scenarios[name](args))
+	except Exception as e:
+		logger.exception(e)
+		queue.put([{'scenario': name, 'error': str(e)}])
+
+
+def run(name, args):
+	queue = multiprocessing.Queue()
+	process = multiprocessing.Process(target=_run, args=(name, args, queue))
+	process.start()
+	results = queue.get()
+	process.join()
+	return results
+
+
+def format_result(r):
+	if 'error' in r:
+		return '%-16s failed: %s' % (r['scenario'], r['error'])
+	line = '%-16s %6d req %8.1f req/s  p50 %7.2fms  p99 %7.2fms  %10d bytes  rss %7dKB (+%dKB)  %.2fs' % (
+		r['scenario'], r['requests'], r['requests_per_sec'], r['p50_ms'], r['p99_ms'],
+		r['bytes'], r['peak_rss_kb'], r['rss_growth_kb'], r['wall'])
+	extra = sorted(k for k in r if k not in (
+		'scenario', 'wall', 'requests', 'requests_per_sec', 'p50_ms', 'p99_ms', 'bytes', 'peak_rss_kb', 'rss_growth_kb'))
+	if extra:
+		line += '\n' + ' ' * 17 + ', '.join('%s=%s' % (k, r[k]) for k in extra)
+	return line
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Benchmark the Control API client against a local mock server.')
+	parser.add_argument('scenarios', nargs='*', help='Scenarios to run: %s (default: all)' % ', '.join(sorted(scenarios)))
+	parser.add_argument('--latency', type=float, default=0.002, help='Seconds the mock adds to every request')
+	parser.add_argument('--jitter', type=float, default=0.0)
+	parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of API requests answered with 503')
+	parser.add_argument('--concurrency', type=int, default=bulk.default_concurrency)
+	parser.add_argument('--topics', type=int, default=20, help='Topics in the sync scenario')
+	parser.add_argument('--keywords', type=int, default=10, help='Keywords per topic in the sync scenario')
+	parser.add_argument('--overlap', type=float, default=0.5, help='Fraction of topics that already exist')
+	parser.add_argument('--collections', type=int, default=50, help='Collections in the listing scenario')
+	parser.add_argument('--inputs', type=int, default=20000, help='Inputs in the listing scenario')
+	parser.add_argument('--page-size', type=int, default=1000)
+	parser.add_argument('--codec', choices=sorted(codec.backends), help='JSON codec of the transport (default: fastest installed)')
+	parser.add_argument('--repeat', type=int, default=5, help='Decodes per codec in the codec scenario')
+	parser.add_argument('--threads', type=int, default=16, help='Threads in the token scenario')
+	parser.add_argument('--duration', type=float, default=5.0, help='Seconds the token scenario runs')
+	parser.add_argument('--token-ttl', type=int, default=1500, help='Token ttl in milliseconds in the token scenario')
+	parser.add_argument('--requests', type=int, default=2000, help='Requests in the multiplex scenarios')
+	parser.add_argument('--multiplex-concurrency', type=int, default=64, help='Requests in flight in the multiplex scenarios')
+	parser.add_argument('--connections', type=int, default=1, help='HTTP/2 connections in the multiplex.http2 scenario')
+	parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+	args = parser.parse_args()
+
+	for name in args.scenarios:
+		if name not in scenarios:
+			parser.error('unknown scenario %s' % name)
+
+	logging.getLogger().setLevel(logging.ERROR)
+	logging.getLogger('frigg.frigg').setLevel(logging.ERROR)
+
+	results = []
+	for name in args.scenarios or sorted(scenarios):
+		results.extend(run(name, args))
+	if args.json:
+		print(json.dumps(results, indent=1, sort_keys=True))
+	else:
+		for r in results:
+			print(format_result(r))
@@ -2,9 +2,10 @@ import sys
 import logging
 import codecs
 
-sys.stdout = codecs.getwriter('utf8')(sys.stdout)
-sys.stderr = codecs.getwriter('utf8')(sys.stderr)
-sys.stdin = codecs.getreader('utf8')(sys.stdin)
+if sys.version_info[0] < 3:
+	sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+	sys.stderr = codecs.getwriter('utf8')(sys.stderr)
+	sys.stdin = codecs.getreader('utf8')(sys.stdin)
 
 logging.basicConfig( \
 	stream=sys.stderr, \
@@ -0,0 +1,394 @@
+'''
+asyncio client for the Control API (Python 3.5+, requires aiohttp).
+
+AsyncControl has the interface of Control with coroutine methods, so the
+resource paths and wrapper classes of controlapi.client are shared:
+
+	control = AsyncControl(base_url, AsyncFrigg(config), contract_id)
+	inputs = control.factory(client.InputFactory)
+	for item in await inputs.list():
+		await item.delete()
+	collection = await control.factory(client.CollectionFactory).create('topic')
+	await collection.add_input('twitter', 'keyword', 'query')
+'''
+import asyncio
+import inspect
+import logging
+import time
+
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
+
+import controlapi.bulk as bulk
+import controlapi.client as client
+import controlapi.json_http as http
+from controlapi.codec import default_codec
+from controlapi.retry import RetryPolicy, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTransport(object):
+	'''
+	aiohttp counterpart of json_http.Transport. limit caps the number of
+	open connections, limit_per_host the connections per host; retry and
+	limiter work as for Transport, codec as well.
+	'''
+	def __init__(self, limit=100, limit_per_host=32, timeout=(5, 60), retry=RetryPolicy(), limiter=None, codec=None):
+		if aiohttp is None:
+			raise ImportError('AsyncTransport requires aiohttp')
+		self.limit = limit
+		self.limit_per_host = limit_per_host
+		self.timeout = timeout
+		self.retry = retry
+		self.limiter = limiter
+		self.codec = codec or default_codec()
+		self._session = None
+
+	def session(self):
+		if self._session is None or self._session.closed:
+			if isinstance(self.timeout, tuple):
+				connect, read = self.timeout
+			else:
+				connect = read = self.timeout
+			self._session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host),
+				timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+			)
+		return self._session
+
+	async def _send(self, method, url, data=None, dedupe_key=None):
+		'''
+		Sends a request, retrying and pacing it, and returns the response
+		once it has a non error status. The caller releases it.
+		'''
+		headers = {}
+		if dedupe_key:
+			headers['Idempotency-Key'] = dedupe_key
+		if method == 'GET':
+			kwargs = {'params': data}
+		elif data is not None:
+			kwargs = {'data': self.codec.dumps(data)}
+			headers['Content-Type'] = 'application/json'
+		else:
+			kwargs = {}
+		attempt = 0
+		while True:
+			if self.limiter:
+				wait = self.limiter.reserve()
+				if wait > 0:
+					await asyncio.sleep(wait)
+			try:
+				r = await self.session().request(method, url, headers=headers, **kwargs)
+			except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+				if not self.retry or not self.retry.can_retry(method, attempt, dedupe_key is not None):
+					raise
+				await asyncio.sleep(self.retry.delay(attempt))
+				attempt += 1
+				continue
+			retry_after = parse_retry_after(r.headers.get('Retry-After'))
+			if self.limiter:
+				if r.status == 429:
+					self.limiter.throttled(retry_after)
+				elif r.status < 500:
+					self.limiter.succeeded()
+			if r.status < 400:
+				return r
+			r.release()
+			if self.retry and self.retry.retry_status(r.status) and \
+					self.retry.can_retry(method, attempt, dedupe_key is not None, retry_after):
+				await asyncio.sleep(self.retry.delay(attempt, retry_after))
+				attempt += 1
+				continue
+			raise http.HTTPError(r.status, url, r)
+
+	async def request(self, method, url, data=None, dedupe_key=None):
+		logger.info('%s', url)
+		r = await self._send(method, url, data, dedupe_key)
+		try:
+			body = await r.read()
+			encoding = r.charset
+		finally:
+			r.release()
+		if encoding and encoding.lower().replace('-', '') not in ('utf8', 'ascii'):
+			body = body.decode(encoding)
+		return self.codec.loads(body)
+
+	async def stream(self, url, data=None):
+		logger.info('%s', url)
+		r = await self._send('GET', url, data)
+		try:
+			parser = http.JsonArrayParser(r.charset or 'utf-8')
+			async for chunk in r.content.iter_chunked(http.stream_chunk_size):
+				for item in parser.feed(chunk):
+					yield item
+			for item in parser.close():
+				yield item
+		finally:
+			r.release()
+
+	async def get(self, url, data=None):
+		return await self.request('GET', url, data)
+
+	async def post(self, url, data=None, dedupe_key=None):
+		return await self.request('POST', url, data, dedupe_key)
+
+	async def patch(self, url, data=None):
+		return await self.request('PATCH', url, data)
+
+	async def delete(self, url, data=None):
+		return await self.request('DELETE', url, data)
+
+	async def close(self):
+		if self._session is not None:
+			await self._session.close()
+			self._session = None
+
+
+async def run(func, items, concurrency=bulk.default_concurrency):
+	'''
+	Awaits func for every item with at most concurrency calls in flight.
+	Failures are collected in the report instead of aborting the run.
+	'''
+	items = list(items)
+	report = bulk.BulkReport(items)
+	errors = [None] * len(items)
+	semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+	async def call(i):
+		async with semaphore:
+			try:
+				report.results[i] = await func(items[i])
+			except Exception as e:
+				logger.warn('%s failed: %s' % (items[i], e))
+				errors[i] = e
+
+	start = time.time()
+	await asyncio.gather(*[call(i) for i in range(len(items))])
+	report.elapsed = time.time() - start
+	report.errors = [(items[i], e) for i, e in enumerate(errors) if e is not None]
+	return report
+
+
+class AsyncControl(client.Control):
+	asynchronous = True
+
+	def __init__(self, base_url, frigg, contract_id, transport=None, coalesce=False, memo_ttl=0):
+		if transport is None:
+			transport = AsyncTransport()
+		client.Control.__init__(self, base_url, frigg, contract_id, transport, coalesce=coalesce, memo_ttl=memo_ttl)
+
+	async def token(self):
+		token = self._frigg.token()
+		if inspect.isawaitable(token):
+			token = await token
+		return token
+
+	async def url(self, path, i=None):
+		return self._url(path, await self.token(), i)
+
+	def factory(self, klass):
+		return async_factory(klass)(self)
+
+	async def load(self, obj):
+		obj.reset(await self.get(obj.path + '/' + obj.id()))
+		return obj.data
+
+	async def get(self, path, params=None):
+		if self._flights is None:
+			return await self._get(path, params)
+		key = client.read_key(path, params)
+		flight, leader = self._flights.join(key, self.generation(path))
+		if not leader:
+			if flight.landed is None:
+				if flight.waiter is None:
+					flight.waiter = asyncio.Event()
+				await flight.waiter.wait()
+			return flight.outcome()
+		try:
+			resp = await self._get(path, params)
+		except BaseException as e:
+			# includes cancellation, which must not leave the waiters hanging
+			self._flights.land(key, flight, error=e)
+			raise
+		self._flights.land(key, flight, resp)
+		return resp
+
+	async def _get(self, path, params=None):
+		url = await self.url(path)
+		logger.info('url  %s', url)
+		resp = await self._http.get(url, params)
+		logger.debug('resp %s', client.LazyJson(resp))
+		return resp
+
+	async def post(self, path, data, dedupe_key=None):
+		url = await self.url(path)
+		logger.info('url  %s', url)
+		logger.debug('data %s', client.LazyJson(data))
+		if dedupe_key:
+			resp = await self._http.post(url, data, dedupe_key)
+		else:
+			resp = await self._http.post(url, data)
+		self._touch(path)
+		logger.debug('resp %s', client.LazyJson(resp))
+		return resp
+
+	async def patch(self, path, data):
+		url = await self.url(path)
+		logger.info('url  %s', url)
+		logger.debug('data %s', client.LazyJson(data))
+		resp = await self._http.patch(url, data)
+		self._touch(path)
+		logger.debug('resp %s', client.LazyJson(resp))
+		return resp
+
+	async def delete(self, path, data):
+		url = await self.url(path)
+		logger.info('url  %s', url)
+		logger.debug('data %s', client.LazyJson(data))
+		try:
+			await self._http.delete(url, data)
+		except ValueError:
+			return data
+		finally:
+			self._touch(path)
+
+	async def list(self, path, cp):
+		return [cp(self, item) for item in await self.get(path)]
+
+	async def iter(self, path, cp, page_size=None, params=None):
+		params = dict(params or {})
+		skip = 0
+		while True:
+			if page_size:
+				params['skip'] = skip
+				params['limit'] = page_size
+			url = await self.url(path)
+			logger.info('url  %s', url)
+			count = 0
+			async for item in self._http.stream(url, params):
+				count += 1
+				yield cp(self, item)
+			if not page_size or count < page_size:
+				return
+			skip += count
+
+	async def close(self):
+		await self._http.close()
+
+
+class AsyncSnapshot(client.Snapshot):
+	async def refresh(self):
+		self.reset(await self.factory.list())
+
+	async def create(self, *args, **kwargs):
+		return self.add(await self.factory.create(*args, **kwargs))
+
+	async def delete(self, item):
+		resp = await item.delete()
+		self.remove(item)
+		return resp
+
+	async def delete_many(self, items, batch_size=None, concurrency=1):
+		report = await self.factory.delete_many(items, batch_size, concurrency)
+		for item in report:
+			self.remove(item)
+		return report
+
+
+class AsyncFactory(client.Factory):
+	'''
+	Coroutine versions of the generic Factory operations. Resource
+	factories get them through async_factory, which places this class
+	right after the resource factory in the MRO so its create(data) is
+	reached by the resource factory's super() call.
+	'''
+	async def list(self):
+		return await self.control.list(self.path, self.klass)
+
+	def iter(self, page_size=None, params=None):
+		return self.control.iter(self.path, self.klass, page_size or self.page_size, params)
+
+	async def snapshot(self):
+		return AsyncSnapshot(self, self.index_fields, await self.list())
+
+	async def index(self):
+		if self._cache_ttl is None:
+			return None
+		cache = self._cache_current()
+		if cache is None:
+			generation = self.control.generation(self.path)
+			cache = self._cache_store(await self.snapshot(), generation)
+		return cache
+
+	async def find(self, name):
+		index = await self.index()
+		if index is not None:
+			return index.find(name)
+		items = self.iter()
+		try:
+			async for item in items:
+				if item.name() == name:
+					return item
+		finally:
+			await items.aclose()
+		return None
+
+	async def find_by(self, field, value):
+		index = await self.index()
+		if index is not None and field in index.fields:
+			return index.select(field, value)
+		return [item async for item in self.iter() if item.data.get(field) == value]
+
+	async def delete_by_name(self, name):
+		item = await self.find(name)
+		if item:
+			cache, generation = self._cache_writing()
+			await item.delete()
+			if cache is not None:
+				cache.remove(item)
+				self._cache_written(cache, generation)
+		return item
+
+	async def delete_many(self, items, batch_size=None, concurrency=1):
+		items = list(items)
+		chunks = self._chunks(items, batch_size)
+
+		async def delete(chunk):
+			return await self.control.delete(self.path, {'ids': [client.object_id(item) for item in chunk]})
+
+		cache, generation = self._cache_writing()
+		return self._deleted(items, await run(delete, chunks, concurrency), cache, generation)
+
+	async def create(self, data):
+		cache, generation = self._cache_writing()
+		item = self.klass(self.control, await self.control.post(self.path, data))
+		if cache is not None:
+			cache.add(item)
+			self._cache_written(cache, generation)
+		return item
+
+	async def create_list(self, data, batch_size=None, concurrency=bulk.default_concurrency):
+		data = list(data)
+		chunks = self._create_chunks(data, batch_size)
+
+		async def create(chunk):
+			return self._wrap_created(chunk, await self.control.post(self.path, chunk if self.bulk_create else chunk[0]))
+
+		cache, generation = self._cache_writing()
+		return self._created(data, chunks, await run(create, chunks, concurrency), cache, generation)
+
+
+_async_factories = {}
+
+def async_factory(klass):
+	'''
+	Returns the asyncio variant of a Factory subclass.
+	'''
+	if klass is client.Factory or issubclass(klass, AsyncFactory):
+		return AsyncFactory if klass is client.Factory else klass
+	if klass not in _async_factories:
+		_async_factories[klass] = type('Async' + klass.__name__, (klass, AsyncFactory), {})
+	return _async_factories[klass]
@@ -0,0 +1,90 @@
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+default_concurrency = 8
+
+
+class BulkReport(object):
+	'''
+	Outcome of a bulk run. results holds the return values in input order
+	(None for failed items), errors holds (item, exception) pairs.
+	'''
+	def __init__(self, items):
+		self.items = items
+		self.results = [None] * len(items)
+		self.errors = []
+		self.elapsed = 0.0
+
+	def ok(self):
+		return not self.errors
+
+	def succeeded(self):
+		return len(self.items) - len(self.errors)
+
+	def failed(self):
+		return len(self.errors)
+
+	def extend(self, other):
+		self.items = self.items + other.items
+		self.results = self.results + other.results
+		self.errors = self.errors + other.errors
+		self.elapsed += other.elapsed
+		return self
+
+	def summary(self):
+		return '%d ok, %d failed in %.2fs' % (self.succeeded(), self.failed(), self.elapsed)
+
+	def __iter__(self):
+		for i, result in enumerate(self.results):
+			if result is not None:
+				yield result
+
+	def __len__(self):
+		return self.succeeded()
+
+
+class Created(list):
+	'''
+	The objects made by a bulk create, in input order and without the
+	failed entries; report is the BulkReport with the errors.
+	'''
+	def __init__(self, report):
+		list.__init__(self, report)
+		self.report = report
+
+
+def run(func, items, concurrency=default_concurrency):
+	'''
+	Calls func on every item using at most concurrency threads. Failures
+	are collected in the report instead of aborting the run.
+	'''
+	items = list(items)
+	report = BulkReport(items)
+	if not items:
+		return report
+	errors = [None] * len(items)
+
+	def call(i):
+		try:
+			report.results[i] = func(items[i])
+		except Exception as e:
+			logger.warn('%s failed: %s' % (items[i], e))
+			errors[i] = e
+
+	start = time.time()
+	if concurrency <= 1 or len(items) == 1:
+		for i in range(len(items)):
+			call(i)
+	else:
+		pool = ThreadPool(min(concurrency, len(items)))
+		try:
+			pool.map(call, range(len(items)))
+		finally:
+			pool.close()
+			pool.join()
+	report.elapsed = time.time() - start
+	report.errors = [(items[i], e) for i, e in enumerate(errors) if e is not None]
+	return report
@@ -0,0 +1,173 @@
+import os
+import json
+import errno
+import hashlib
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+
+try:
+	from urlparse import urlsplit, parse_qsl
+	from urllib import urlencode, quote, unquote
+except ImportError:
+	from urllib.parse import urlsplit, parse_qsl, urlencode, quote, unquote
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(url, params=None):
+	'''
+	Identifies a GET by url and params, ignoring the access token so the key
+	survives token refreshes.
+	'''
+	parts = urlsplit(url)
+	query = [(k, v) for k, v in parse_qsl(parts.query) if k != 'access_token']
+	if params:
+		query.extend((k, str(v)) for k, v in params.items())
+	return parts.path + '?' + urlencode(sorted(query))
+
+
+class DiskStore(object):
+	'''
+	Keeps cache entries as one JSON file per key in a directory. File names
+	start with the quoted url path so entries can be dropped by path
+	without reading them.
+	'''
+	def __init__(self, directory):
+		self.directory = directory
+		try:
+			os.makedirs(directory)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+
+	def _path(self, key):
+		path = quote(key.split('?', 1)[0], safe='')
+		return os.path.join(self.directory, path + '.' + hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+	def load(self, key):
+		try:
+			with open(self._path(key)) as f:
+				entry = json.load(f)
+		except (IOError, ValueError):
+			return None
+		if entry.get('key') != key:
+			return None
+		return entry
+
+	def save(self, key, entry):
+		entry = dict(entry, key=key)
+		fd, tmp = tempfile.mkstemp(dir=self.directory)
+		try:
+			with os.fdopen(fd, 'w') as f:
+				json.dump(entry, f)
+			os.rename(tmp, self._path(key))
+		except Exception:
+			os.unlink(tmp)
+			raise
+
+	def delete(self, key):
+		try:
+			os.unlink(self._path(key))
+		except OSError:
+			pass
+
+	def delete_paths(self, matches):
+		'''
+		Deletes the entries whose url path matches(path).
+		'''
+		for name in os.listdir(self.directory):
+			if not name.endswith('.json') or '.' not in name[:-5]:
+				continue
+			if matches(unquote(name[:-5].rsplit('.', 1)[0])):
+				try:
+					os.unlink(os.path.join(self.directory, name))
+				except OSError:
+					pass
+
+
+class ResponseCache(object):
+	'''
+	Bounded LRU of decoded GET responses with their ETag and Last-Modified
+	validators, optionally backed by a DiskStore for reuse across runs.
+
+	Cached values are shared instead of copied on every 304, which for
+	large listings would cost more than decoding them again. A wrapper
+	edited in place edits the cached value too, until the write saving it
+	drops the entry, whether the write succeeds or not; callers that modify
+	results without saving them must copy them first.
+	'''
+	def __init__(self, maxsize=256, store=None):
+		self.maxsize = maxsize
+		self.store = store
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is not None:
+				self._entries[key] = entry
+				return entry
+		if self.store is None:
+			return None
+		entry = self.store.load(key)
+		if entry is not None:
+			self._remember(key, entry)
+		return entry
+
+	def put(self, key, value, etag=None, last_modified=None):
+		if not etag and not last_modified:
+			return
+		entry = {
+			'etag': etag,
+			'last_modified': last_modified,
+			'value': value
+		}
+		self._remember(key, entry)
+		if self.store is not None:
+			try:
+				self.store.save(key, entry)
+			except Exception as e:
+				logger.warn('Could not store %s: %s', key, e)
+
+	def _remember(self, key, entry):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = entry
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+
+	def headers(self, entry):
+		headers = {}
+		if entry.get('etag'):
+			headers['If-None-Match'] = entry['etag']
+		if entry.get('last_modified'):
+			headers['If-Modified-Since'] = entry['last_modified']
+		return headers
+
+	def hit(self, entry):
+		self.hits += 1
+		return entry['value']
+
+	def invalidate(self, url):
+		'''
+		Drops the entries for the written path, anything below it and the
+		listings it belongs to, in memory and in the store, including the
+		stored entries no longer held in memory.
+		'''
+		path = urlsplit(url).path.rstrip('/')
+		with self._lock:
+			keys = [key for key in self._entries if self._related(key.split('?', 1)[0], path)]
+			for key in keys:
+				del self._entries[key]
+		if self.store is not None:
+			self.store.delete_paths(lambda cached: self._related(cached, path))
+
+	def _related(self, cached, written):
+		return cached == written or \
+			cached.startswith(written + '/') or \
+			written.startswith(cached + '/')
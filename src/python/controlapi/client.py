@@ -1,22 +1,185 @@
 import logging
 import json
-import urllib
+import threading
+import time
+import contextlib
+import copy
+from collections import OrderedDict
 
 import controlapi.json_http as http
+import controlapi.bulk as bulk
+import controlapi.metrics as metrics
+
+try:
+	from urllib import quote
+except ImportError:
+	from urllib.parse import quote
 
 logger = logging.getLogger(__name__)
 
 base_url = 'https://api.crowdynews.com/v1/'
 
 def slugify(s):
-	return urllib.quote(s)
+	return quote(s)
+
+resource_path = http.resource_path
+
+class LazyJson(object):
+	'''
+	Pretty-prints obj only when a log record is actually formatted.
+	'''
+	def __init__(self, obj):
+		self.obj = obj
+
+	def __str__(self):
+		return json.dumps(self.obj, indent=2)
+
+try:
+	basestring
+except NameError:
+	basestring = str
+
+_interned = {}
+max_interned = 4096
+
+def intern_value(value):
+	'''
+	Returns a shared copy of a frequently repeated string (service and type
+	names, collection ids) so large listings hold each one only once. Only
+	used for low cardinality fields; the table stops growing at
+	max_interned entries and other values are returned as they are.
+	'''
+	if not isinstance(value, basestring):
+		return value
+	shared = _interned.get(value)
+	if shared is not None:
+		return shared
+	if len(_interned) >= max_interned:
+		return value
+	return _interned.setdefault(value, value)
+
+def object_id(item):
+	if isinstance(item, ControlableObject):
+		return item.id()
+	return item
+
+def read_key(path, params=None):
+	return (path, json.dumps(params, sort_keys=True) if params else None)
+
+
+class Flight(object):
+	'''
+	One read in progress or, once landed, its remembered outcome.
+	'''
+	def __init__(self, generation):
+		self.generation = generation
+		self.landed = None
+		self.result = None
+		self.error = None
+		self.event = threading.Event()
+		self.waiter = None
+
+	def outcome(self):
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+	def wait(self):
+		self.event.wait()
+		return self.outcome()
+
+
+class Flights(object):
+	'''
+	Coalesces identical reads: callers asking for a key that is already
+	being fetched wait for that request and share its decoded result.
+	With memo_ttl the result keeps being served for that many seconds.
+	Entries are tied to the resource generation they were read at, so a
+	write to the resource makes later reads fetch again.
+	'''
+	max_entries = 256
+
+	def __init__(self, memo_ttl=0):
+		self.memo_ttl = memo_ttl
+		self._lock = threading.Lock()
+		self._flights = {}
+		self.coalesced = 0
+		self.memo_hits = 0
+
+	def join(self, key, generation):
+		'''
+		Returns the flight for key and whether the caller leads it, that
+		is has to fetch and land it.
+		'''
+		with self._lock:
+			flight = self._flights.get(key)
+			if flight is not None and flight.generation == generation:
+				if flight.landed is None:
+					self.coalesced += 1
+					return flight, False
+				if time.time() - flight.landed < self.memo_ttl:
+					self.memo_hits += 1
+					return flight, False
+			flight = self._flights[key] = Flight(generation)
+			if len(self._flights) > self.max_entries:
+				self._purge()
+			return flight, True
+
+	def land(self, key, flight, result=None, error=None):
+		with self._lock:
+			flight.result = result
+			flight.error = error
+			flight.landed = time.time()
+			if (error is not None or not self.memo_ttl) and self._flights.get(key) is flight:
+				del self._flights[key]
+		flight.event.set()
+		if flight.waiter is not None:
+			flight.waiter.set()
+
+	def invalidate(self, path):
+		path = resource_path(path)
+		with self._lock:
+			for key in [key for key, flight in self._flights.items() if flight.landed is not None and resource_path(key[0]) == path]:
+				del self._flights[key]
+
+	def _purge(self):
+		now = time.time()
+		for key in [key for key, flight in self._flights.items() if flight.landed is not None and now - flight.landed >= self.memo_ttl]:
+			del self._flights[key]
 
 
 class Control(object):
-	def __init__(self, base_url, frigg, contract_id):
+	'''
+	Entry point to the Control API of one contract.
+
+	With instruments (metrics.Instruments) every call runs in a span that
+	times its phases, from the token lookup to building the wrappers.
+
+	With coalesce, concurrent identical get() calls share one request, and
+	memo_ttl additionally serves repeats from the first result for that
+	many seconds (see Flights). Callers then share the decoded data, so
+	wrappers made from it must not be modified independently.
+	'''
+	# AsyncControl's calls return coroutines
+	asynchronous = False
+
+	def __init__(self, base_url, frigg, contract_id, transport=None, instruments=None, coalesce=False, memo_ttl=0):
 		self._base_url = base_url
 		self._frigg = frigg
 		self._contract_id = contract_id
+		if transport is None:
+			transport = http.default_transport()
+		self._http = transport
+		self._instruments = instruments
+		self._flights = Flights(memo_ttl) if coalesce or memo_ttl else None
+		self._generations = {}
+		self._generations_lock = threading.Lock()
+
+	def transport(self):
+		return self._http
+
+	def instruments(self):
+		return self._instruments
 
 	def token(self):
 		return self._frigg.token()
@@ -25,91 +188,570 @@ class Control(object):
 		return self._contract_id
 
 	def url(self, path, i=None):
+		return self._url(path, self.token(), i)
+
+	def _url(self, path, token, i=None):
 		url = self._base_url + path
 		if i:
 			url += '/' + i
-		url += '?access_token=' + self.token() + '&contract_id=' + self._contract_id
+		url += '?access_token=' + token + '&contract_id=' + self._contract_id
 		return url
 
-	def get(self, path):
-		url = self.url(path)
-		logger.info('url  %s' % url)
-		resp = http.get(url)
-		logger.debug('resp %s' % json.dumps(resp, indent=2))
+	def factory(self, klass):
+		return klass(self)
+
+	def load(self, obj):
+		obj.reset(self.get(obj.path + '/' + obj.id()))
+		return obj.data
+
+	def generation(self, path):
+		return self._generations.get(resource_path(path), 0)
+
+	def _touch(self, path):
+		path = resource_path(path)
+		with self._generations_lock:
+			self._generations[path] = self._generations.get(path, 0) + 1
+		if self._flights is not None:
+			self._flights.invalidate(path)
+
+	def stats(self):
+		if self._flights is None:
+			return {'coalesced': 0, 'memo_hits': 0}
+		return {'coalesced': self._flights.coalesced, 'memo_hits': self._flights.memo_hits}
+
+	def _begin(self, method, path, kind='client'):
+		'''
+		Starts the span of a call, timing the token lookup, and returns it
+		with the url.
+		'''
+		label = resource_path(path)
+		span = self._instruments.start(method + ' ' + label, method, label, kind)
+		start = time.time()
+		try:
+			token = self.token()
+		except Exception as e:
+			self._instruments.end(span, e)
+			raise
+		span.add_phase('auth', time.time() - start)
+		return span, self._url(path, token)
+
+	def _call(self, method, path, send):
+		'''
+		Calls send(url) for path, inside a span when instrumented.
+		'''
+		if self._instruments is None:
+			url = self.url(path)
+			logger.info('url  %s', url)
+			return send(url)
+		span, url = self._begin(method, path)
+		logger.info('url  %s', url)
+		previous = metrics.activate(span)
+		try:
+			resp = send(url)
+		except Exception as e:
+			self._instruments.end(span, e)
+			raise
+		finally:
+			metrics.activate(previous)
+		self._instruments.end(span)
+		return resp
+
+	def get(self, path, params=None):
+		if self._flights is None:
+			return self._get(path, params)
+		key = read_key(path, params)
+		flight, leader = self._flights.join(key, self.generation(path))
+		if not leader:
+			return flight.wait()
+		try:
+			resp = self._get(path, params)
+		except BaseException as e:
+			# land on interrupts too, or followers of this key would wait forever
+			self._flights.land(key, flight, error=e)
+			raise
+		self._flights.land(key, flight, resp)
+		return resp
+
+	def _get(self, path, params=None):
+		resp = self._call('GET', path, lambda url: self._http.get(url, params))
+		logger.debug('resp %s', LazyJson(resp))
 		return resp
 
-	def post(self, path, data):
-		url = self.url(path)
-		logger.info('url  %s' % url)
-		logger.debug('data %s' % json.dumps(data, indent=2))
-		resp = http.post(url, data)
-		logger.debug('resp %s' % json.dumps(resp, indent=2))
+	def post(self, path, data, dedupe_key=None):
+		logger.debug('data %s', LazyJson(data))
+		if dedupe_key:
+			resp = self._call('POST', path, lambda url: self._http.post(url, data, dedupe_key))
+		else:
+			resp = self._call('POST', path, lambda url: self._http.post(url, data))
+		self._touch(path)
+		logger.debug('resp %s', LazyJson(resp))
 		return resp
 
 	def patch(self, path, data):
-		url = self.url(path)
-		logger.info('url  %s' % url)
-		logger.debug('data %s' % json.dumps(data, indent=2))
-		resp = http.patch(url, data)
-		logger.debug('resp %s' % json.dumps(resp, indent=2))
+		logger.debug('data %s', LazyJson(data))
+		resp = self._call('PATCH', path, lambda url: self._http.patch(url, data))
+		self._touch(path)
+		logger.debug('resp %s', LazyJson(resp))
 		return resp
 
 	def delete(self, path, data):
-		url = self.url(path)
-		logger.info('url  %s' % url)
-		logger.debug('data %s' % json.dumps(data, indent=2))
-		try:
-			resp = http.delete(url, data)
-		except ValueError as e:
-			return data
+		logger.debug('data %s', LazyJson(data))
 
-#		logger.debug('resp %s' % json.dumps(resp, indent=2))
-#		return resp
+		def send(url):
+			try:
+				self._http.delete(url, data)
+			except ValueError as e:
+				return data
+		try:
+			return self._call('DELETE', path, send)
+		finally:
+			self._touch(path)
 
 	def list(self, path, cp):
+		if self._instruments is not None:
+			return self._list_traced(path, cp)
 		resp = self.get(path)
 		ret = []
 		for item in resp:
 			ret.append(cp(self, item))
 		return ret
 
+	def _list_traced(self, path, cp):
+		with self._instruments.span('list ' + resource_path(path), method='GET', path=resource_path(path)) as span:
+			resp = self.get(path)
+			start = time.time()
+			ret = [cp(self, item) for item in resp]
+			span.add_phase('wrap', time.time() - start)
+			return ret
+
+	def iter(self, path, cp, page_size=None, params=None):
+		'''
+		Lazily yields wrapped items, streaming each response. With page_size
+		the listing is fetched in skip/limit pages until a short page.
+		'''
+		params = dict(params or {})
+		skip = 0
+		while True:
+			if page_size:
+				params['skip'] = skip
+				params['limit'] = page_size
+			count = 0
+			if self._instruments is None:
+				for item in self._call('GET', path, lambda url: self._http.stream(url, params)):
+					count += 1
+					yield cp(self, item)
+			else:
+				for item in self._iter_traced(path, cp, params):
+					count += 1
+					yield item
+			if not page_size or count < page_size:
+				return
+			skip += count
+
+	def _iter_traced(self, path, cp, params):
+		'''
+		Yields the wrapped items of one page; its span times reading and
+		wrapping, not the consumer's work between items.
+		'''
+		span, url = self._begin('GET', path)
+		logger.info('url  %s', url)
+		previous = metrics.activate(span)
+		try:
+			items = iter(self._http.stream(url, params))
+		except Exception as e:
+			self._instruments.end(span, e)
+			raise
+		finally:
+			metrics.activate(previous)
+		error = None
+		try:
+			while True:
+				start = time.time()
+				try:
+					item = next(items)
+				except StopIteration:
+					span.add_phase('read', time.time() - start)
+					break
+				wrapped = time.time()
+				span.add_phase('read', wrapped - start)
+				item = cp(self, item)
+				span.add_phase('wrap', time.time() - wrapped)
+				yield item
+		except Exception as e:
+			error = e
+			raise
+		finally:
+			self._instruments.end(span, error)
+
+
+class Snapshot(object):
+	'''
+	Listing of a resource fetched once and indexed by id, name and the
+	factory's index_fields. Creates and deletes made through the snapshot
+	are applied to it so later steps see current state without refetching.
+	'''
+	def __init__(self, factory, fields=(), items=None):
+		self.factory = factory
+		self.fields = fields
+		self._lock = threading.RLock()
+		if items is None:
+			self.refresh()
+		else:
+			self.reset(items)
+
+	def refresh(self):
+		self.reset(self.factory.list())
+
+	def reset(self, items):
+		with self._lock:
+			# by id in listing order, so removing an item is O(1)
+			self._items = OrderedDict()
+			self._by_name = {}
+			self._by_field = dict((field, {}) for field in self.fields)
+			for item in items:
+				self.add(item)
+
+	def list(self):
+		with self._lock:
+			return list(self._items.values())
+
+	def iter(self):
+		return iter(self.list())
+
+	def get(self, id):
+		return self._items.get(id)
+
+	def find(self, name):
+		with self._lock:
+			named = self._by_name.get(name)
+			return named[0] if named else None
+
+	def select(self, field, value):
+		with self._lock:
+			return list(self._by_field[field].get(value, {}).values())
+
+	def add(self, item):
+		with self._lock:
+			if item.id() in self._items:
+				self.remove(self._items[item.id()])
+			self._items[item.id()] = item
+			if item.name() is not None:
+				self._by_name.setdefault(item.name(), []).append(item)
+			for field in self.fields:
+				self._by_field[field].setdefault(item.data.get(field), OrderedDict())[item.id()] = item
+		return item
+
+	def remove(self, item):
+		with self._lock:
+			item = self._items.pop(object_id(item), None)
+			if item is None:
+				return None
+			named = self._by_name.get(item.name())
+			if named:
+				named.remove(item)
+				if not named:
+					del self._by_name[item.name()]
+			for field in self.fields:
+				selected = self._by_field[field].get(item.data.get(field))
+				if selected is not None:
+					selected.pop(item.id(), None)
+					if not selected:
+						del self._by_field[field][item.data.get(field)]
+		return item
+
+	def create(self, *args, **kwargs):
+		return self.add(self.factory.create(*args, **kwargs))
+
+	def delete(self, item):
+		resp = item.delete()
+		self.remove(item)
+		return resp
+
+	def delete_many(self, items, batch_size=None, concurrency=1):
+		report = self.factory.delete_many(items, batch_size, concurrency)
+		for item in report:
+			self.remove(item)
+		return report
+
+	def __iter__(self):
+		return iter(self.list())
+
+	def __len__(self):
+		return len(self._items)
+
+
+class Columns(object):
+	'''
+	Column oriented view of a listing: one list of values per field and no
+	wrapper objects, for filtering very large listings. The values of the
+	interned fields, which repeat a lot, are shared.
+	'''
+	def __init__(self, rows, fields, interned=()):
+		self.fields = tuple(fields)
+		self.columns = dict((field, []) for field in self.fields)
+		columns = [(self.columns[field], field in interned) for field in self.fields]
+		for row in rows:
+			for field, (column, intern) in zip(self.fields, columns):
+				value = row.get(field)
+				column.append(intern_value(value) if intern else value)
+
+	def __len__(self):
+		return len(self.columns[self.fields[0]]) if self.fields else 0
+
+	def column(self, field):
+		return self.columns[field]
+
+	def where(self, **criteria):
+		'''
+		Row numbers whose fields equal all the given values.
+		'''
+		rows = None
+		for field, value in criteria.items():
+			column = self.columns[field]
+			if rows is None:
+				rows = [i for i, v in enumerate(column) if v == value]
+			else:
+				rows = [i for i in rows if column[i] == value]
+		if rows is None:
+			return list(range(len(self)))
+		return rows
+
+	def rows(self, numbers):
+		return [dict((field, self.columns[field][i]) for field in self.fields) for i in numbers]
+
 
 class Factory(object):
+	column_fields = ('_id', 'name')
+	interned_fields = ()
+	index_fields = ()
+	max_batch_size = 100
+	bulk_create = False
+	page_size = None
+
 	def __init__(self, path, klass, control):
 		self.control = control
 		self.path = path
 		self.klass = klass
+		self._cache = None
+		self._cache_ttl = None
+		self._cache_time = 0
+		self._cache_generation = None
+		self._cache_lock = threading.Lock()
 
 	def list(self):
 		return self.control.list(self.path, self.klass)
 
+	def iter(self, page_size=None, params=None):
+		return self.control.iter(self.path, self.klass, page_size or self.page_size, params)
+
+	def snapshot(self):
+		return Snapshot(self, self.index_fields)
+
+	def columns(self, fields=None, page_size=None):
+		rows = self.control.iter(self.path, lambda control, item: item, page_size or self.page_size)
+		return Columns(rows, fields or self.column_fields, self.interned_fields)
+
+	def enable_cache(self, ttl=60):
+		'''
+		Keeps an indexed snapshot of the listing for ttl seconds so find and
+		find_by are served from memory. Any write to this resource through
+		the same Control invalidates it.
+		'''
+		self._cache_ttl = ttl
+		self.invalidate()
+		return self
+
+	def invalidate(self):
+		with self._cache_lock:
+			self._cache = None
+
+	def _cache_fresh(self):
+		return self._cache is not None and \
+			time.time() - self._cache_time < self._cache_ttl and \
+			self._cache_generation == self.control.generation(self.path)
+
+	def _cache_writing(self):
+		'''
+		Returns the cached snapshot and its generation before a write, or
+		(None, None) if it is not fresh. The write is applied to that
+		snapshot, then _cache_written keeps it only if it is still the cache
+		and no one else wrote to the resource in the meantime.
+		'''
+		with self._cache_lock:
+			generation = self.control.generation(self.path)
+			if self._cache_fresh() and self._cache_generation == generation:
+				return self._cache, generation
+			return None, None
+
+	def _cache_written(self, cache, generation, writes=1):
+		with self._cache_lock:
+			if self._cache is not cache:
+				return
+			if self._cache_generation == generation and self.control.generation(self.path) == generation + writes:
+				self._cache_generation = generation + writes
+			else:
+				self._cache = None
+
+	def _cache_current(self):
+		with self._cache_lock:
+			return self._cache if self._cache_fresh() else None
+
+	def _cache_store(self, cache, generation):
+		with self._cache_lock:
+			self._cache = cache
+			self._cache_time = time.time()
+			self._cache_generation = generation
+		return cache
+
+	def index(self):
+		if self._cache_ttl is None:
+			return None
+		cache = self._cache_current()
+		if cache is None:
+			generation = self.control.generation(self.path)
+			cache = self._cache_store(self.snapshot(), generation)
+		return cache
+
 	def find(self, name):
-		for item in self.list():
+		index = self.index()
+		if index is not None:
+			return index.find(name)
+		for item in self.iter():
 			if item.name() == name:
 				return item
 		return None
 
+	def find_by(self, field, value):
+		index = self.index()
+		if index is not None and field in index.fields:
+			return index.select(field, value)
+		return [item for item in self.iter() if item.data.get(field) == value]
+
 	def delete_by_name(self, name):
 		item = self.find(name)
 		if item:
+			cache, generation = self._cache_writing()
 			item.delete()
+			if cache is not None:
+				cache.remove(item)
+				self._cache_written(cache, generation)
 		return item
 
+	def delete_many(self, items, batch_size=None, concurrency=1):
+		'''
+		Deletes objects or ids sending up to batch_size ids per request.
+		Returns a bulk report over the given items; all items of a failed
+		request are reported as failed.
+		'''
+		items = list(items)
+		chunks = self._chunks(items, batch_size)
+
+		def delete(chunk):
+			return self.control.delete(self.path, {'ids': [object_id(item) for item in chunk]})
+
+		cache, generation = self._cache_writing()
+		return self._deleted(items, bulk.run(delete, chunks, concurrency), cache, generation)
+
 	def create(self, data):
-		return self.klass(self.control, self.control.post(self.path, data))
+		cache, generation = self._cache_writing()
+		item = self.klass(self.control, self.control.post(self.path, data))
+		if cache is not None:
+			cache.add(item)
+			self._cache_written(cache, generation)
+		return item
 
-	def create_list(self, data):
-		ret = []
-		for item in data:
-			ret.append(self.klass(self.control, self.control.post(self.path, data)))
-		return ret
+	def create_list(self, data, batch_size=None, concurrency=bulk.default_concurrency):
+		'''
+		Creates one object per entry in data. Endpoints that accept a list
+		(bulk_create) get chunks of up to batch_size entries per request,
+		others get one request per entry on a bounded thread pool. Returns
+		the created objects in input order as a list (bulk.Created) whose
+		report attribute holds the failed entries and their errors.
+		'''
+		data = list(data)
+		chunks = self._create_chunks(data, batch_size)
+
+		def create(chunk):
+			return self._wrap_created(chunk, self.control.post(self.path, chunk if self.bulk_create else chunk[0]))
+
+		cache, generation = self._cache_writing()
+		return self._created(data, chunks, bulk.run(create, chunks, concurrency), cache, generation)
+
+	def _chunks(self, items, batch_size=None):
+		size = batch_size or self.max_batch_size
+		return [items[i:i + size] for i in range(0, len(items), size)]
+
+	def _create_chunks(self, data, batch_size=None):
+		if not self.bulk_create:
+			return [[item] for item in data]
+		return self._chunks(data, batch_size)
+
+	def _wrap_created(self, chunk, resp):
+		if isinstance(resp, dict):
+			resp = [resp]
+		if not isinstance(resp, list) or len(resp) != len(chunk):
+			raise ValueError('Expected %d created objects, got %r' % (len(chunk), resp))
+		return [self.klass(self.control, item) for item in resp]
+
+	def _created(self, data, chunks, chunked, cache, generation):
+		report = bulk.BulkReport(data)
+		report.elapsed = chunked.elapsed
+		offset = 0
+		for i, chunk in enumerate(chunks):
+			if chunked.results[i] is not None:
+				report.results[offset:offset + len(chunk)] = chunked.results[i]
+				if cache is not None:
+					for item in chunked.results[i]:
+						cache.add(item)
+			offset += len(chunk)
+		for chunk, e in chunked.errors:
+			report.errors.extend((item, e) for item in chunk)
+		if cache is not None:
+			# failed posts do not touch the resource
+			self._cache_written(cache, generation, len(chunks) - len(chunked.errors))
+		return bulk.Created(report)
+
+	def _deleted(self, items, chunked, cache, generation):
+		report = bulk.BulkReport(items)
+		report.elapsed = chunked.elapsed
+		failed = set()
+		for chunk, e in chunked.errors:
+			for item in chunk:
+				report.errors.append((item, e))
+				failed.add(object_id(item))
+		for i, item in enumerate(items):
+			if object_id(item) not in failed:
+				report.results[i] = item
+				if cache is not None:
+					cache.remove(item)
+		if cache is not None:
+			# every delete request touches the resource, failed or not
+			self._cache_written(cache, generation, len(chunked.results))
+		return report
 
 
 class ControlableObject(object):
+	'''
+	Wrapper around the data of one API object.
+
+	Fields changed through set() or mark_dirty() are tracked and patch()
+	only sends those; without tracked changes the whole data is sent.
+	Inside a batch() block the object's own save operations (such as
+	FilterList.add) and direct changes to data are collected and sent as
+	one PATCH on exit.
+
+	Wrappers use __slots__ to stay small in large listings; subclasses
+	declare their own (usually empty) __slots__.
+	'''
+	__slots__ = ('control', 'data', 'path', '_dirty', '_batch', '_key')
+
 	def __init__(self, path, control, data):
 		self.control = control
 		self.data = data
 		self.path = path
+		self._dirty = None
+		self._batch = 0
+		self._key = None
 
 	def id(self):
 		return self.data['_id']
@@ -119,19 +761,68 @@ class ControlableObject(object):
 			return self.data['name']
 		return None
 
+	def reset(self, data):
+		self.data = data
+		self._dirty = None
+		self._key = None
+
+	def set(self, field, value):
+		self.data[field] = value
+		self.mark_dirty(field)
+
+	def mark_dirty(self, field):
+		if self._dirty is None:
+			self._dirty = set()
+		self._dirty.add(field)
+		self._key = None
+
+	def dirty(self):
+		return set(self._dirty or ())
+
 	def get(self):
-		self.data = self.control.get(self.path + '/' + self.id())
-		return self.data
+		return self.control.load(self)
 
 	def patch(self):
-		return self.control.patch(self.path + '/' + self.id(), self.data)
+		if self._dirty:
+			data = dict((field, self.data[field]) for field in self._dirty if field in self.data)
+		else:
+			data = self.data
+		resp = self.control.patch(self.path + '/' + self.id(), data)
+		self._dirty = None
+		return resp
 
 	def delete(self):
 		data = {'ids':[self.id()]}
 		return self.control.delete(self.path, data)
 
-
-
+	@contextlib.contextmanager
+	def batch(self):
+		'''
+		Defers the saves made inside the block to a single PATCH of the
+		changed fields. Fields assigned or modified in data directly are
+		sent too; removing a field cannot be expressed as a PATCH and is not.
+		Not available with AsyncControl, whose patch() has to be awaited.
+		'''
+		if self.control.asynchronous:
+			raise TypeError('batch() needs a synchronous Control; save and await patch() instead')
+		before = copy.deepcopy(self.data) if not self._batch else None
+		self._batch += 1
+		try:
+			yield self
+		finally:
+			self._batch -= 1
+		if self._batch:
+			return
+		for field, value in self.data.items():
+			if field not in before or before[field] != value:
+				self.mark_dirty(field)
+		if self._dirty:
+			self.patch()
+
+	def _save(self):
+		if self._batch:
+			return None
+		return self.patch()
 
 
 class CollectionFactory(Factory):
@@ -154,6 +845,10 @@ class CollectionFactory(Factory):
 
 
 class InputFactory(Factory):
+	index_fields = ('collectionId',)
+	column_fields = ('_id', 'collectionId', 'service', 'type', 'input')
+	interned_fields = ('collectionId', 'contractId', 'service', 'type')
+
 	def __init__(self, control):
 		Factory.__init__(self, 'collection/inputs', Input, control)
 
@@ -248,6 +943,8 @@ class FilterListFactory(Factory):
 
 
 class FilterSetFactory(Factory):
+	bulk_create = True
+
 	def __init__(self, control):
 		Factory.__init__(self, 'filter/sets', FilterSet, control)
 
@@ -291,52 +988,78 @@ class Operator(Enum):
 
 
 class Collection(ControlableObject):
+	__slots__ = ()
+
 	def __init__(self, control, data):
 		ControlableObject.__init__(self, 'collection/collections', control, data)
 
-	def set_filter(filter):
-		self.data['filterId'] = filter.id()
-		self.patch()
+	def set_filter(self, filter):
+		self.set('filterId', filter.id())
+		return self._save()
 
 	def add_input(self, service, taip, query):
-		return InputFactory(self.control).create(self, service, taip, query)
+		return self.control.factory(InputFactory).create(self, service, taip, query)
 
 	def create_publication(self, name, description):
-		return PublicationFactory(self.control).create(self, name)
+		return self.control.factory(PublicationFactory).create(self, name)
 
 
 class Input(ControlableObject):
+	__slots__ = ()
+	interned_fields = ('collectionId', 'contractId', 'service', 'type')
+
 	def __init__(self, control, data):
+		for field in self.interned_fields:
+			if field in data:
+				data[field] = intern_value(data[field])
 		ControlableObject.__init__(self, 'collection/inputs', control, data)
 
 	def name(self):
-		d = self.data
-		return d['service'] + ':' + d['type'] + ':' + d['input']
+		if self._key is None:
+			d = self.data
+			self._key = d['service'] + ':' + d['type'] + ':' + d['input']
+		return self._key
 
 class Publication(ControlableObject):
+	__slots__ = ()
+
 	def __init__(self, control, data):
 		ControlableObject.__init__(self, 'publication/publications', control, data)
 
 
 class Customization(ControlableObject):
+	__slots__ = ()
+
 	def __init__(self, control, data):
 		ControlableObject.__init__(self, 'publication/customizations', control, data)
 
 
 class FilterChain(ControlableObject):
+	__slots__ = ()
+
 	def __init__(self, control, data):
 		ControlableObject.__init__(self, 'filter/chains', control, data)
 
 
 class FilterSet(ControlableObject):
+	__slots__ = ()
+
 	def __init__(self, control, data):
 		ControlableObject.__init__(self, 'filter/sets', control, data)
 
 
 class FilterList(ControlableObject):
+	__slots__ = ()
+
 	def __init__(self, control, data):
 		ControlableObject.__init__(self, 'filter/lists', control, data)
 
 	def add(self, string):
 		self.data['entries'].append(string)
-		self.patch()
+		self.mark_dirty('entries')
+		return self._save()
+
+	def add_many(self, strings):
+		self.data['entries'].extend(strings)
+		self.mark_dirty('entries')
+		return self._save()
@@ -0,0 +1,105 @@
+'''
+JSON codecs for the transports.
+
+A codec has loads(data), which parses UTF-8 bytes (or text) directly, and
+dumps(obj), which returns UTF-8 bytes. orjson and ujson are used when
+installed, the standard library otherwise:
+
+	codec = get_codec()          # fastest available
+	codec = get_codec('json')    # force the standard library
+'''
+import json
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import ujson
+except ImportError:
+	ujson = None
+
+
+class StdlibCodec(object):
+	name = 'json'
+
+	def loads(self, data):
+		if isinstance(data, bytes) and bytes is not str:
+			data = data.decode('utf-8')
+		return json.loads(data)
+
+	def dumps(self, obj):
+		data = json.dumps(obj, separators=(',', ':'))
+		if not isinstance(data, bytes):
+			data = data.encode('utf-8')
+		return data
+
+
+class OrjsonCodec(object):
+	name = 'orjson'
+
+	def __init__(self):
+		if orjson is None:
+			raise ImportError('OrjsonCodec requires orjson')
+
+	def loads(self, data):
+		return orjson.loads(data)
+
+	def dumps(self, obj):
+		return orjson.dumps(obj)
+
+
+class UjsonCodec(object):
+	name = 'ujson'
+
+	def __init__(self):
+		if ujson is None:
+			raise ImportError('UjsonCodec requires ujson')
+
+	def loads(self, data):
+		return ujson.loads(data)
+
+	def dumps(self, obj):
+		data = ujson.dumps(obj, ensure_ascii=False)
+		if not isinstance(data, bytes):
+			data = data.encode('utf-8')
+		return data
+
+
+backends = {
+	'json': StdlibCodec,
+	'orjson': OrjsonCodec,
+	'ujson': UjsonCodec
+}
+
+def available():
+	'''
+	Names of the installed codecs, fastest first.
+	'''
+	names = []
+	if orjson is not None:
+		names.append('orjson')
+	if ujson is not None:
+		names.append('ujson')
+	names.append('json')
+	return names
+
+def get_codec(name=None):
+	'''
+	The codec called name, or the fastest installed one.
+	'''
+	return backends[name or available()[0]]()
+
+
+_default_codec = None
+
+def default_codec():
+	global _default_codec
+	if _default_codec is None:
+		_default_codec = get_codec()
+	return _default_codec
+
+def set_default_codec(codec):
+	global _default_codec
+	_default_codec = codec
@@ -0,0 +1,148 @@
+'''
+HTTP/2 transport for Control (Python 3, requires httpx with the http2 extra).
+
+Http2Transport has the interface and options of json_http.Transport but
+multiplexes concurrent requests as streams over a few connections per host
+instead of opening one connection per request in flight:
+
+	control = client.Control(base_url, frigg, contract_id, Http2Transport())
+
+HTTP/2 is negotiated with ALPN on https URLs. For cleartext servers pass
+http1=False to speak HTTP/2 with prior knowledge.
+'''
+import asyncio
+import datetime
+import threading
+import time
+import logging
+
+try:
+	import httpx
+except ImportError:
+	httpx = None
+
+import controlapi.json_http as http
+from controlapi.retry import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+
+class Http2Request(object):
+	def __init__(self, body):
+		self.body = body
+
+
+class Http2Response(object):
+	'''
+	Presents an httpx response with the requests.Response attributes that
+	json_http.Transport uses. elapsed is the time until the response was
+	returned, which for non streamed requests includes reading the body.
+	'''
+	def __init__(self, r, elapsed, run):
+		self._r = r
+		self._run = run
+		self.status_code = r.status_code
+		self.headers = r.headers
+		self.url = str(r.url)
+		self.request = Http2Request(r.request.content)
+		self.encoding = r.charset_encoding
+		self.elapsed = datetime.timedelta(seconds=elapsed)
+
+	@property
+	def content(self):
+		return self._run(self._r.aread())
+
+	def iter_content(self, chunk_size):
+		chunks = self._r.aiter_bytes(chunk_size)
+		while True:
+			try:
+				yield self._run(chunks.__anext__())
+			except StopAsyncIteration:
+				return
+
+	def close(self):
+		self._run(self._r.aclose())
+
+
+def request_params(params):
+	'''
+	Encodes query parameters the way requests does, for httpx: None values
+	are dropped instead of sent as empty strings and booleans are sent as
+	True/False instead of true/false. Lists become repeated parameters.
+	'''
+	if not params:
+		return None
+	if isinstance(params, dict):
+		params = params.items()
+	encoded = []
+	for key, values in params:
+		if isinstance(values, (str, bytes)) or not hasattr(values, '__iter__'):
+			values = [values]
+		for value in values:
+			if value is None:
+				continue
+			if isinstance(value, bool):
+				value = str(value)
+			encoded.append((key, value))
+	return encoded
+
+
+class Http2Transport(http.Transport):
+	'''
+	max_connections caps the connections per transport; with HTTP/2 one
+	connection per host usually carries all requests. The other options are
+	those of json_http.Transport.
+
+	The connections belong to an httpx.AsyncClient on an event loop thread
+	owned by the transport; calling threads block until their request is
+	done. (httpx's threaded client can interleave the frames of concurrent
+	requests out of stream order, which servers reject.)
+	'''
+	def __init__(self, max_connections=4, http1=True, timeout=(5, 60), recorder=None, retry=RetryPolicy(), limiter=None, cache=None, instruments=None, semaphore=None, codec=None):
+		if httpx is None:
+			raise ImportError('Http2Transport requires httpx[http2]')
+		self.max_connections = max_connections
+		self.http1 = http1
+		self.connection_errors = (httpx.TransportError,)
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever, name='http2-transport')
+		self.thread.daemon = True
+		self.thread.start()
+		http.Transport.__init__(self, timeout=timeout, recorder=recorder, retry=retry, limiter=limiter, cache=cache, instruments=instruments, semaphore=semaphore, codec=codec)
+
+	def _run(self, coroutine):
+		return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+	def _session(self, pool_connections, pool_maxsize, pool_block):
+		if isinstance(self.timeout, tuple):
+			connect, read = self.timeout
+			timeout = httpx.Timeout(read, connect=connect)
+		else:
+			timeout = httpx.Timeout(self.timeout)
+		return httpx.AsyncClient(
+			http1=self.http1,
+			http2=True,
+			timeout=timeout,
+			limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+		)
+
+	def _request(self, method, url, headers, stream, kwargs):
+		request = self.session.build_request(method, url, headers=headers, params=request_params(kwargs.get('params')), content=kwargs.get('data'))
+		start = time.time()
+		r = self._run(self.session.send(request, stream=stream))
+		return Http2Response(r, time.time() - start, self._run)
+
+	def _connections(self, url):
+		return None
+
+	def http_version(self, url):
+		'''
+		The protocol version spoken with url's host, e.g. 'HTTP/2'.
+		'''
+		return self._run(self.session.head(url)).http_version
+
+	def close(self):
+		self._run(self.session.aclose())
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.loop.close()
@@ -1,47 +1,475 @@
-import urllib2
 import json
+import codecs
+import re
+import threading
+import time
 import requests
+import requests.adapters
+
+try:
+	from urlparse import urlsplit
+except ImportError:
+	from urllib.parse import urlsplit
+
+import controlapi.metrics as metrics
+from controlapi.retry import RetryPolicy, parse_retry_after
+from controlapi.cache import cache_key
+from controlapi.codec import default_codec
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+stream_chunk_size = 64 * 1024
+
 def handleException(r, e):
 	raise e
 
+def resource_path(path):
+	'''
+	The resource part of an API path such as collection/inputs/<id>, which
+	labels metrics without the object ids.
+	'''
+	return '/'.join(path.split('/')[:2])
+
+def url_resource_path(url):
+	'''
+	resource_path of an API url, whose path starts with the API version.
+	'''
+	return resource_path(urlsplit(url).path.strip('/').split('/', 1)[-1])
+
+
+class HTTPError(Exception):
+	def __init__(self, status_code, url, response=None):
+		Exception.__init__(self, str(status_code) + ' on ' + url.split('?', 1)[0])
+		self.status_code = status_code
+		self.url = url
+		self.response = response
+
+# text up to the next bracket or quote, skipping whole strings, and at the
+# top level of an element also up to the next comma
+_string = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_skip_top = re.compile(r'(?:[^"\[\]{},]+|' + _string + ')*', re.S)
+_skip_nested = re.compile(r'(?:[^"\[\]{}]+|' + _string + ')*', re.S)
+# the rest of a string up to its closing quote or a trailing backslash
+_string_rest = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S)
+_whitespace = re.compile(r'[ \t\r\n]*')
+
+class JsonArrayParser(object):
+	'''
+	Push parser for a top level JSON array. feed() takes byte chunks and
+	returns the elements completed so far, holding at most one element plus
+	one chunk in memory. Elements that end within the chunk they start in
+	are decoded directly; the others are scanned once, tracking nesting and
+	strings, and decoded when their closing , or ] arrives.
+	'''
+	def __init__(self, encoding='utf-8'):
+		self._decoder = json.JSONDecoder()
+		self._text = codecs.getincrementaldecoder(encoding)()
+		self._element = []
+		self._depth = 0
+		self._in_string = False
+		self._escape = False
+		self._started = False
+		self._finished = False
+
+	def feed(self, chunk):
+		return self._parse(self._text.decode(chunk))
+
+	def close(self):
+		items = self._parse(self._text.decode(b'', True))
+		if not self._finished:
+			raise ValueError('Unexpected end of JSON array')
+		return items
+
+	def _parse(self, text):
+		items = []
+		pos = start = 0
+		end = len(text)
+		while pos < end and not self._finished:
+			if not self._started:
+				pos = _whitespace.match(text, pos).end()
+				if pos == end:
+					break
+				if text[pos] != u'[':
+					raise ValueError('Expected a JSON array, got %s' % text[pos:pos + 200])
+				self._started = True
+				pos = start = pos + 1
+				continue
+			if self._in_string:
+				if self._escape:
+					self._escape = False
+					pos += 1
+					continue
+				pos = _string_rest.match(text, pos).end()
+				if pos == end:
+					break
+				if text[pos] == u'\\':
+					# the escaped character is in the next chunk
+					self._escape = True
+				else:
+					self._in_string = False
+				pos += 1
+				continue
+			if pos == start and not self._element:
+				pos = _whitespace.match(text, pos).end()
+				try:
+					item, after = self._decoder.raw_decode(text, pos)
+				except ValueError:
+					pass
+				else:
+					# a value at the end of the chunk may be a truncated number
+					after = _whitespace.match(text, after).end()
+					if after < end and text[after] in u',]':
+						items.append(item)
+						self._finished = text[after] == u']'
+						pos = start = after + 1
+						continue
+			pos = (_skip_nested if self._depth else _skip_top).match(text, pos).end()
+			if pos == end:
+				break
+			c = text[pos]
+			if c == u'"':
+				self._in_string = True
+			elif c in u'[{':
+				self._depth += 1
+			elif self._depth:
+				# mismatched brackets are left to the decoder
+				self._depth -= 1
+			elif c == u'}':
+				raise ValueError('Unexpected } in JSON array')
+			else:
+				element = u''.join(self._element) + text[start:pos]
+				self._element = []
+				if element.strip():
+					items.append(self._decoder.decode(element))
+				self._finished = c == u']'
+				start = pos + 1
+			pos += 1
+		if self._started and not self._finished:
+			self._element.append(text[start:])
+		return items
+
+def iter_json_array(chunks, encoding='utf-8'):
+	'''
+	Yields the elements of a top level JSON array read from an iterable of
+	byte chunks.
+	'''
+	parser = JsonArrayParser(encoding)
+	for chunk in chunks:
+		for item in parser.feed(chunk):
+			yield item
+	for item in parser.close():
+		yield item
+
+
+class Transport(object):
+	'''
+	Pooled keep-alive HTTP transport built on a shared requests.Session.
+
+	pool_connections is the number of hosts to keep a pool for, pool_maxsize
+	the number of connections kept per host. With pool_block the per-host
+	limit is enforced, otherwise surplus connections are opened and
+	discarded. timeout is a (connect, read) tuple or a single number.
+
+	Failed requests are retried according to retry (a RetryPolicy, None to
+	disable) and, when a limiter (retry.RateLimiter) is given, requests are
+	paced by it and 429s slow it down. Responses with an error status that
+	are not retried raise HTTPError. A semaphore (for instance a
+	multiprocessing.BoundedSemaphore shared by worker processes) caps the
+	requests in flight; it is held until the response headers arrive.
+
+	Request and response bodies go through codec (see controlapi.codec,
+	the fastest installed one by default), which parses the response bytes
+	without decoding them to text first.
+
+	With a cache (cache.ResponseCache) GETs are sent conditionally with the
+	stored ETag/Last-Modified and a 304 is answered from the cache; writes
+	drop the affected entries.
+
+	Every request is logged at DEBUG with method, status, size and timing as
+	structured fields (record attribute 'http'); recorder, when given, is
+	called with the same dict.
+
+	Requests made while a metrics span is active on the thread (as Control
+	does when given Instruments) record their phases in it; instruments
+	makes the transport start its own spans for requests made outside one.
+
+	Subclasses built on other HTTP clients (see controlapi.http2) override
+	_session, _request, _connections and connection_errors and return
+	responses with the requests.Response attributes used here.
+	'''
+	connection_errors = (requests.ConnectionError, requests.Timeout)
+
+	def __init__(self, pool_connections=4, pool_maxsize=16, pool_block=False, timeout=(5, 60), recorder=None, retry=RetryPolicy(), limiter=None, cache=None, instruments=None, semaphore=None, codec=None):
+		self.timeout = timeout
+		self.codec = codec or default_codec()
+		self.semaphore = semaphore
+		self.instruments = instruments
+		self.cache = cache
+		self.recorder = recorder
+		self.retry = retry
+		self.limiter = limiter
+		self.session = self._session(pool_connections, pool_maxsize, pool_block)
+
+	def _session(self, pool_connections, pool_maxsize, pool_block):
+		session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(
+			pool_connections=pool_connections,
+			pool_maxsize=pool_maxsize,
+			pool_block=pool_block
+		)
+		session.mount('https://', adapter)
+		session.mount('http://', adapter)
+		return session
+
+	def _request(self, method, url, headers, stream, kwargs):
+		return self.session.request(method, url, headers=headers, timeout=self.timeout, stream=stream, **kwargs)
+
+	def _connections(self, url):
+		'''
+		Number of connections opened so far to url's host, None if unknown.
+		'''
+		return self.session.get_adapter(url).poolmanager.connection_from_url(url).num_connections
+
+	def _send(self, method, url, data=None, dedupe_key=None, stream=False, headers=None, span=None):
+		'''
+		Sends a request, retrying and pacing it, and returns the response
+		once it has a non error status.
+		'''
+		if dedupe_key:
+			headers = dict(headers or {}, **{'Idempotency-Key': dedupe_key})
+		if method == 'GET':
+			kwargs = {'params': data}
+		elif data is not None:
+			kwargs = {'data': self.codec.dumps(data)}
+			headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+		else:
+			kwargs = {}
+		attempt = 0
+		while True:
+			if self.limiter:
+				if span is not None:
+					start = time.time()
+					self.limiter.acquire()
+					span.add_phase('throttle', time.time() - start)
+				else:
+					self.limiter.acquire()
+			if span is not None:
+				opened = self._connections(url)
+			start = time.time()
+			try:
+				if self.semaphore is not None:
+					with self.semaphore:
+						r = self._request(method, url, headers, stream, kwargs)
+				else:
+					r = self._request(method, url, headers, stream, kwargs)
+			except self.connection_errors as e:
+				if span is not None:
+					span.add_phase('wait', time.time() - start)
+				if not self.retry or not self.retry.can_retry(method, attempt, dedupe_key is not None):
+					raise
+				delay = self.retry.delay(attempt)
+				logger.warn('%s %s failed (%s), retrying in %.2fs', method, url.split('?', 1)[0], e, delay)
+				self._backoff(span, delay)
+				attempt += 1
+				continue
+			elapsed = time.time() - start
+			if span is not None:
+				self._observe(span, r, elapsed, stream, None if opened is None else self._connections(url) - opened)
+			if self.recorder or logger.isEnabledFor(logging.DEBUG):
+				self._record(method, r, elapsed, stream)
+			retry_after = parse_retry_after(r.headers.get('Retry-After'))
+			if self.limiter:
+				if r.status_code == 429:
+					self.limiter.throttled(retry_after)
+				elif r.status_code < 500:
+					self.limiter.succeeded()
+			if r.status_code < 400:
+				return r
+			if self.retry and self.retry.retry_status(r.status_code) and \
+					self.retry.can_retry(method, attempt, dedupe_key is not None, retry_after):
+				delay = self.retry.delay(attempt, retry_after)
+				logger.warn('%s %s returned %s, retrying in %.2fs', method, url.split('?', 1)[0], r.status_code, delay)
+				r.close()
+				self._backoff(span, delay)
+				attempt += 1
+				continue
+			raise HTTPError(r.status_code, url, r)
+
+	def _backoff(self, span, delay):
+		if span is not None:
+			span.add_phase('backoff', delay)
+			span.count('http.retries')
+		time.sleep(delay)
+
+	def _observe(self, span, r, elapsed, stream, opened):
+		wait = r.elapsed.total_seconds()
+		span.add_phase('wait', wait)
+		if not stream:
+			span.add_phase('transfer', max(elapsed - wait, 0.0))
+			span.attributes['http.response_bytes'] = len(r.content)
+		body = r.request.body
+		span.attributes['http.request_bytes'] = len(body) if body else 0
+		span.status = r.status_code
+		if opened:
+			span.count('net.connections_opened', opened)
+
+	def _start(self, method, url):
+		'''
+		The active span, or a new one when the transport is instrumented
+		itself. The second value tells whether the caller has to end it.
+		'''
+		span = metrics.current()
+		if span is not None or self.instruments is None:
+			return span, False
+		path = url_resource_path(url)
+		return self.instruments.start(method + ' ' + path, method, path), True
+
+	def _loads(self, r):
+		encoding = r.encoding
+		if encoding and encoding.lower().replace('-', '') not in ('utf8', 'ascii'):
+			return self.codec.loads(r.content.decode(encoding))
+		return self.codec.loads(r.content)
+
+	def _decode(self, r, span):
+		if span is None:
+			return self._loads(r)
+		start = time.time()
+		value = self._loads(r)
+		span.add_phase('decode', time.time() - start)
+		return value
+
+	def request(self, method, url, data=None, dedupe_key=None):
+		r = None
+		span, own = self._start(method, url)
+		try:
+			logger.info('%s', url)
+			if method == 'GET' and self.cache is not None:
+				value = self._cached_get(url, data, span)
+			else:
+				try:
+					r = self._send(method, url, data, dedupe_key, span=span)
+				finally:
+					# also when the write fails, since an edit made in place
+					# to a cached value must not outlive a rejected save
+					if method != 'GET' and self.cache is not None:
+						self.cache.invalidate(url)
+				value = self._decode(r, span)
+		except Exception as e:
+			if own:
+				self.instruments.end(span, e)
+			handleException(r, e)
+		if own:
+			self.instruments.end(span)
+		return value
+
+	def _cached_get(self, url, data, span=None):
+		key = cache_key(url, data)
+		entry = self.cache.get(key)
+		headers = self.cache.headers(entry) if entry else None
+		r = self._send('GET', url, data, headers=headers, span=span)
+		if r.status_code == 304 and entry:
+			if span is not None:
+				span.attributes['http.cache'] = 'hit'
+			return self.cache.hit(entry)
+		self.cache.misses += 1
+		value = self._decode(r, span)
+		self.cache.put(key, value, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+		return value
+
+	def _record(self, method, r, elapsed, stream=False):
+		body = r.request.body
+		if stream:
+			size = int(r.headers.get('Content-Length') or 0)
+		else:
+			size = len(r.content)
+		fields = {
+			'method': method,
+			'url': str(r.url).split('?', 1)[0],
+			'status': r.status_code,
+			'request_bytes': len(body) if body else 0,
+			'response_bytes': size,
+			'elapsed': elapsed
+		}
+		logger.debug('%(method)s %(url)s %(status)s %(request_bytes)d/%(response_bytes)d bytes %(elapsed).3fs', fields, extra={'http': fields})
+		if self.recorder:
+			self.recorder(fields)
+
+	def stream(self, url, data=None):
+		'''
+		GETs a JSON array and returns an iterator over its elements that
+		parses the body while it is still being received. The request is
+		sent right away.
+		'''
+		logger.info('%s', url)
+		span, own = self._start('GET', url)
+		try:
+			r = self._send('GET', url, data, stream=True, span=span)
+		except Exception as e:
+			if own:
+				self.instruments.end(span, e)
+			raise
+		return self._iter_body(r, span if own else None)
+
+	def _iter_body(self, r, span=None):
+		error = None
+		try:
+			for item in iter_json_array(r.iter_content(stream_chunk_size), r.encoding or 'utf-8'):
+				yield item
+		except Exception as e:
+			error = e
+			raise
+		finally:
+			r.close()
+			if span is not None:
+				self.instruments.end(span, error)
+
+	def get(self, url, data=None):
+		return self.request('GET', url, data)
+
+	def post(self, url, data=None, dedupe_key=None):
+		return self.request('POST', url, data, dedupe_key)
+
+	def patch(self, url, data=None):
+		return self.request('PATCH', url, data)
+
+	def delete(self, url, data=None):
+		return self.request('DELETE', url, data)
+
+	def close(self):
+		self.session.close()
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+def default_transport():
+	'''
+	Returns the transport shared by the module level functions.
+	'''
+	global _default_transport
+	if _default_transport is None:
+		with _default_lock:
+			if _default_transport is None:
+				_default_transport = Transport()
+	return _default_transport
+
+def set_default_transport(transport):
+	global _default_transport
+	_default_transport = transport
+
 def get(url, data=None):
-	r = None
-	try:
-		logger.info(url)
-		r = requests.get(url, params=data)
-		return r.json()
-	except Exception as e:
-		handleException(r, e)
-
-def post(url, data=None):
-	r = None
-	try:
-		logger.info(url)
-		r = requests.post(url, json=data)
-		return r.json()
-	except Exception as e:
-		handleException(r, e)
+	return default_transport().get(url, data)
+
+def stream(url, data=None):
+	return default_transport().stream(url, data)
+
+def post(url, data=None, dedupe_key=None):
+	return default_transport().post(url, data, dedupe_key)
 
 def patch(url, data=None):
-	r = None
-	try:
-		logger.info(url)
-		r = requests.patch(url, json=data)
-		return r.json()
-	except Exception as e:
-		handleException(r, e)
+	return default_transport().patch(url, data)
 
 def delete(url, data=None):
-	r = None
-	try:
-		logger.info(url)
-		r = requests.delete(url, json=data)
-		return r.json()
-	except Exception as e:
-		handleException(r, e)
-
+	return default_transport().delete(url, data)
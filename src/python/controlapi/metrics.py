@@ -0,0 +1,433 @@
+'''
+Request instrumentation for Control and json_http.Transport.
+
+An Instruments object passed to Control (or to a Transport used on its own)
+starts a Span for every API call and ends it with the response status.
+Spans carry the time spent per phase:
+
+	auth      obtaining the access token
+	throttle  waiting for the rate limiter
+	wait      sending the request until the response headers arrive,
+	          including connection setup and server time
+	transfer  receiving the body
+	decode    parsing the JSON
+	read      receiving and parsing a streamed body
+	wrap      building wrapper objects
+	backoff   sleeping between retries
+
+Hooks are objects with on_start(span) and on_end(span) methods; Metrics
+aggregates ended spans into Prometheus counters, gauges and histograms and
+the span exporters write them out OpenTelemetry style. Without Instruments
+the only cost per request is a None check.
+'''
+import os
+import json
+import random
+import tempfile
+import threading
+import time
+import contextlib
+import logging
+
+try:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+
+try:
+	from opentelemetry import trace as otel_trace
+except ImportError:
+	otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+def current():
+	'''
+	The span active on this thread, if any.
+	'''
+	return getattr(_local, 'span', None)
+
+def activate(span):
+	'''
+	Makes span the active span of this thread and returns the one it
+	replaces, to be restored with another activate call.
+	'''
+	previous = getattr(_local, 'span', None)
+	_local.span = span
+	return previous
+
+def _new_id(bits):
+	return '%0*x' % (bits // 4, random.getrandbits(bits))
+
+
+class Span(object):
+	'''
+	One API call (kind 'client') or a caller defined operation (kind
+	'internal'). method and path, the resource path, label the metrics.
+	'''
+	def __init__(self, name, method=None, path=None, kind='client', parent=None, attributes=None):
+		self.name = name
+		self.method = method
+		self.path = path
+		self.kind = kind
+		self.trace_id = parent.trace_id if parent else _new_id(128)
+		self.span_id = _new_id(64)
+		self.parent_id = parent.span_id if parent else None
+		self.attributes = dict(attributes or {})
+		self.phases = {}
+		self.status = None
+		self.error = None
+		self.start = time.time()
+		self.end = None
+
+	def add_phase(self, phase, seconds):
+		self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+	def count(self, attribute, n=1):
+		self.attributes[attribute] = self.attributes.get(attribute, 0) + n
+
+	def duration(self):
+		return (self.end or time.time()) - self.start
+
+	def to_dict(self):
+		attributes = dict(self.attributes)
+		if self.method:
+			attributes['http.method'] = self.method
+		if self.path:
+			attributes['controlapi.path'] = self.path
+		if self.status is not None:
+			attributes['http.status_code'] = self.status
+		for phase, seconds in self.phases.items():
+			attributes['controlapi.phase.' + phase] = seconds
+		return {
+			'name': self.name,
+			'kind': self.kind,
+			'trace_id': self.trace_id,
+			'span_id': self.span_id,
+			'parent_id': self.parent_id,
+			'start_time': self.start,
+			'end_time': self.end,
+			'attributes': attributes,
+			'status': 'ERROR' if self.error is not None or (self.status or 0) >= 400 else 'OK',
+			'error': str(self.error) if self.error is not None else None
+		}
+
+
+class Hook(object):
+	'''
+	Adapts a pair of callables taking the span to the hook interface.
+	'''
+	def __init__(self, before=None, after=None):
+		self.before = before
+		self.after = after
+
+	def on_start(self, span):
+		if self.before:
+			self.before(span)
+
+	def on_end(self, span):
+		if self.after:
+			self.after(span)
+
+
+class Instruments(object):
+	'''
+	Starts and ends spans and hands them to metrics and hooks. Hook
+	failures are logged and do not affect the request.
+	'''
+	def __init__(self, metrics=None, hooks=()):
+		self.metrics = metrics
+		self.hooks = list(hooks)
+
+	def add_hook(self, hook=None, before=None, after=None):
+		self.hooks.append(hook or Hook(before, after))
+
+	def start(self, name, method=None, path=None, kind='client', **attributes):
+		span = Span(name, method, path, kind, current(), attributes)
+		if self.metrics is not None:
+			self.metrics.started(span)
+		for hook in self.hooks:
+			try:
+				hook.on_start(span)
+			except Exception as e:
+				logger.warn('Hook %s failed: %s', hook, e)
+		return span
+
+	def end(self, span, error=None):
+		span.end = time.time()
+		if error is not None:
+			span.error = error
+			if span.status is None:
+				span.status = getattr(error, 'status_code', None)
+		if self.metrics is not None:
+			self.metrics.ended(span)
+		for hook in self.hooks:
+			try:
+				hook.on_end(span)
+			except Exception as e:
+				logger.warn('Hook %s failed: %s', hook, e)
+
+	@contextlib.contextmanager
+	def span(self, name, **attributes):
+		'''
+		Runs a block as an internal span that the API calls made in it on
+		this thread are children of.
+		'''
+		span = self.start(name, kind='internal', **attributes)
+		previous = activate(span)
+		try:
+			yield span
+		except Exception as e:
+			self.end(span, e)
+			raise
+		else:
+			self.end(span)
+		finally:
+			activate(previous)
+
+
+def _labels(names, values):
+	return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values)) + '}'
+
+
+class Metrics(object):
+	'''
+	Prometheus style aggregation of ended spans: request, byte and retry
+	counters per method, resource path and status, request duration
+	histograms, phase time totals and an in-flight gauge.
+	'''
+	def __init__(self, prefix='controlapi', buckets=default_buckets):
+		self.prefix = prefix
+		self.buckets = tuple(buckets)
+		self._lock = threading.Lock()
+		self._requests = {}
+		self._in_flight = {}
+		self._durations = {}
+		self._phases = {}
+		self._bytes = {}
+		self._retries = {}
+		self._connections = {}
+
+	def started(self, span):
+		if span.kind != 'client':
+			return
+		key = (span.method, span.path)
+		with self._lock:
+			self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+	def ended(self, span):
+		key = (span.method, span.path)
+		with self._lock:
+			for phase, seconds in span.phases.items():
+				phase_key = key + (phase,)
+				self._phases[phase_key] = self._phases.get(phase_key, 0.0) + seconds
+			if span.kind != 'client':
+				return
+			self._in_flight[key] -= 1
+			status = span.status if span.status is not None else 'error'
+			request_key = key + (status,)
+			self._requests[request_key] = self._requests.get(request_key, 0) + 1
+			histogram = self._durations.get(key)
+			if histogram is None:
+				histogram = self._durations[key] = [0] * len(self.buckets) + [0, 0.0]
+			duration = span.duration()
+			for i, bound in enumerate(self.buckets):
+				if duration <= bound:
+					histogram[i] += 1
+			histogram[-2] += 1
+			histogram[-1] += duration
+			for direction in ('request', 'response'):
+				n = span.attributes.get('http.%s_bytes' % direction)
+				if n:
+					bytes_key = key + (direction,)
+					self._bytes[bytes_key] = self._bytes.get(bytes_key, 0) + n
+			if span.attributes.get('http.retries'):
+				self._retries[key] = self._retries.get(key, 0) + span.attributes['http.retries']
+			if span.attributes.get('net.connections_opened'):
+				self._connections[key] = self._connections.get(key, 0) + span.attributes['net.connections_opened']
+
+	def in_flight(self):
+		with self._lock:
+			return dict(self._in_flight)
+
+	def export(self):
+		'''
+		A picklable copy of the totals, for merging into the Metrics of
+		another process.
+		'''
+		with self._lock:
+			return {
+				'requests': dict(self._requests),
+				'durations': dict((key, list(histogram)) for key, histogram in self._durations.items()),
+				'phases': dict(self._phases),
+				'bytes': dict(self._bytes),
+				'retries': dict(self._retries),
+				'connections': dict(self._connections)
+			}
+
+	def merge(self, exported):
+		'''
+		Adds totals returned by export() to these metrics.
+		'''
+		with self._lock:
+			for name in ('requests', 'phases', 'bytes', 'retries', 'connections'):
+				totals = getattr(self, '_' + name)
+				for key, value in exported[name].items():
+					totals[key] = totals.get(key, 0) + value
+			for key, histogram in exported['durations'].items():
+				if key not in self._durations:
+					self._durations[key] = [0] * len(self.buckets) + [0, 0.0]
+				self._durations[key] = [a + b for a, b in zip(self._durations[key], histogram)]
+
+	def requests(self):
+		'''
+		Total number of ended requests.
+		'''
+		with self._lock:
+			return sum(self._requests.values())
+
+	def render(self):
+		'''
+		The metrics in the Prometheus text exposition format.
+		'''
+		p = self.prefix
+		lines = []
+
+		def family(name, type, help, samples, labels):
+			lines.append('# HELP %s_%s %s' % (p, name, help))
+			lines.append('# TYPE %s_%s %s' % (p, name, type))
+			for key, value in sorted(samples.items(), key=lambda s: tuple(str(k) for k in s[0])):
+				lines.append('%s_%s%s %s' % (p, name, _labels(labels, key), value))
+
+		with self._lock:
+			family('requests_total', 'counter', 'API requests by method, resource path and status.', self._requests, ('method', 'path', 'status'))
+			family('requests_in_flight', 'gauge', 'API requests currently in flight.', self._in_flight, ('method', 'path'))
+			lines.append('# HELP %s_request_duration_seconds API request duration including retries.' % p)
+			lines.append('# TYPE %s_request_duration_seconds histogram' % p)
+			for key, histogram in sorted(self._durations.items()):
+				for bound, count in zip(self.buckets, histogram):
+					lines.append('%s_request_duration_seconds_bucket%s %d' % (p, _labels(('method', 'path', 'le'), key + (repr(bound),)), count))
+				lines.append('%s_request_duration_seconds_bucket%s %d' % (p, _labels(('method', 'path', 'le'), key + ('+Inf',)), histogram[-2]))
+				lines.append('%s_request_duration_seconds_count%s %d' % (p, _labels(('method', 'path'), key), histogram[-2]))
+				lines.append('%s_request_duration_seconds_sum%s %r' % (p, _labels(('method', 'path'), key), histogram[-1]))
+			family('phase_seconds_total', 'counter', 'Time spent per request phase.', self._phases, ('method', 'path', 'phase'))
+			family('bytes_total', 'counter', 'Request and response body bytes.', self._bytes, ('method', 'path', 'direction'))
+			family('retries_total', 'counter', 'Retried requests.', self._retries, ('method', 'path'))
+			family('connections_opened_total', 'counter', 'New connections opened by requests (approximate under concurrency).', self._connections, ('method', 'path'))
+		return '\n'.join(lines) + '\n'
+
+	def write(self, path):
+		'''
+		Atomically writes the metrics to path, e.g. for the node exporter
+		textfile collector.
+		'''
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+		try:
+			with os.fdopen(fd, 'w') as f:
+				f.write(self.render())
+			os.rename(tmp, path)
+		except Exception:
+			os.unlink(tmp)
+			raise
+
+	def serve(self, port=9464, host=''):
+		'''
+		Serves the metrics over HTTP on a daemon thread and returns the
+		server; call shutdown() on it to stop.
+		'''
+		metrics = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.render().encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		server = HTTPServer((host, port), Handler)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return server
+
+
+class MemoryExporter(object):
+	'''
+	Keeps the ended spans in a list.
+	'''
+	def __init__(self):
+		self.spans = []
+
+	def on_start(self, span):
+		pass
+
+	def on_end(self, span):
+		self.spans.append(span)
+
+
+class JsonSpanExporter(object):
+	'''
+	Writes every ended span as one JSON line to a file object or path.
+	'''
+	def __init__(self, out):
+		if isinstance(out, str):
+			out = open(out, 'a')
+		self.out = out
+		self._lock = threading.Lock()
+
+	def on_start(self, span):
+		pass
+
+	def on_end(self, span):
+		line = json.dumps(span.to_dict(), sort_keys=True)
+		with self._lock:
+			self.out.write(line + '\n')
+			self.out.flush()
+
+	def close(self):
+		self.out.close()
+
+
+class OpenTelemetryExporter(object):
+	'''
+	Mirrors the spans into an OpenTelemetry tracer (requires
+	opentelemetry-api), keeping the parent/child relations.
+	'''
+	def __init__(self, tracer=None):
+		if otel_trace is None:
+			raise ImportError('OpenTelemetryExporter requires opentelemetry-api')
+		self.tracer = tracer or otel_trace.get_tracer(__name__)
+		self._open = {}
+		self._lock = threading.Lock()
+
+	def on_start(self, span):
+		context = None
+		with self._lock:
+			parent = self._open.get(span.parent_id)
+		if parent is not None:
+			context = otel_trace.set_span_in_context(parent)
+		kind = otel_trace.SpanKind.CLIENT if span.kind == 'client' else otel_trace.SpanKind.INTERNAL
+		otel_span = self.tracer.start_span(span.name, context=context, kind=kind, start_time=int(span.start * 1e9))
+		with self._lock:
+			self._open[span.span_id] = otel_span
+
+	def on_end(self, span):
+		with self._lock:
+			otel_span = self._open.pop(span.span_id, None)
+		if otel_span is None:
+			return
+		for name, value in span.to_dict()['attributes'].items():
+			otel_span.set_attribute(name, value)
+		if span.error is not None:
+			otel_span.record_exception(span.error)
+			otel_span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, str(span.error)))
+		otel_span.end(end_time=int(span.end * 1e9))
@@ -0,0 +1,148 @@
+'''
+Reconciles a topics configuration (the topics.json format) with the
+collections and inputs of a contract.
+
+The configuration is turned into a desired set of (service, type, input)
+keys per topic and compared with the actual inputs as sets, so building a
+plan is linear in the number of keywords and inputs. A Plan can be
+printed, used as a dry run, or executed.
+'''
+import logging
+
+import controlapi.bulk as bulk
+
+logger = logging.getLogger(__name__)
+
+
+def input_key(item):
+	d = item.data
+	return (d['service'], d['type'], d['input'])
+
+def key_name(key):
+	return ':'.join(key)
+
+def desired_keys(services, keywords):
+	return set((service, services[service], keyword) for keyword in keywords for service in services)
+
+def desired_state(config):
+	'''
+	Maps every topic of a topics configuration to its set of input keys.
+	'''
+	services = config['services']
+	return dict((topic, desired_keys(services, keywords)) for topic, keywords in config['topics'].items())
+
+
+class TopicPlan(object):
+	def __init__(self, topic, desired, collection, create, delete, unchanged):
+		self.topic = topic
+		self.desired = desired
+		self.collection = collection
+		self.create = create
+		self.delete = delete
+		self.unchanged = unchanged
+
+	def changed(self):
+		return self.collection is None or bool(self.create) or bool(self.delete)
+
+	def format(self, verbose=True):
+		where = self.collection.id() if self.collection else 'new collection'
+		lines = ['%s (%s): +%d -%d =%d' % (self.topic, where, len(self.create), len(self.delete), self.unchanged)]
+		if verbose:
+			lines.extend('  + ' + key_name(key) for key in self.create)
+			lines.extend('  - ' + item.name() for item in self.delete)
+		return '\n'.join(lines)
+
+
+class PlanResult(object):
+	def __init__(self, collections, created, deleted):
+		self.collections = collections
+		self.created = created
+		self.deleted = deleted
+
+	def ok(self):
+		return self.collections.ok() and self.created.ok() and self.deleted.ok()
+
+	def summary(self):
+		return 'collections %s; inputs created %s, deleted %s' % \
+			(self.collections.summary(), self.created.summary(), self.deleted.summary())
+
+
+class Plan(object):
+	def __init__(self, topics):
+		self.topics = topics
+
+	def changes(self):
+		return [topic for topic in self.topics if topic.changed()]
+
+	def format(self, verbose=True):
+		return '\n'.join(topic.format(verbose) for topic in self.topics)
+
+	def summary(self):
+		return '%d topics, %d changed: +%d -%d inputs' % (
+			len(self.topics),
+			len(self.changes()),
+			sum(len(topic.create) for topic in self.topics),
+			sum(len(topic.delete) for topic in self.topics)
+		)
+
+	def dry_run(self):
+		return self.format() + '\n' + self.summary()
+
+	def execute(self, collections, inputs, concurrency=bulk.default_concurrency):
+		'''
+		Creates missing collections, then removes stale inputs of all topics
+		in batched deletes and creates new inputs on a bounded thread pool.
+		collections and inputs are the Snapshots the plan was made from and
+		are kept up to date.
+		'''
+		missing = [topic for topic in self.topics if topic.collection is None]
+
+		def create_collection(topic):
+			topic.collection = collections.create(topic.topic)
+			return topic.collection
+		created_collections = bulk.run(create_collection, missing, concurrency)
+
+		stale = [item for topic in self.topics for item in topic.delete]
+		for item in stale:
+			logger.warn('Deleting %s from %s' % (item.name(), item.data['collectionId']))
+		deleted = inputs.delete_many(stale, concurrency=concurrency)
+
+		def create_input(spec):
+			collection, key = spec
+			return inputs.add(collection.add_input(*key))
+		specs = [(topic.collection, key) for topic in self.topics if topic.collection is not None for key in topic.create]
+		created = bulk.run(create_input, specs, concurrency)
+
+		for topic, e in created_collections.errors:
+			logger.error('Failed to create collection %s: %s' % (topic.topic, e))
+		for item, e in deleted.errors:
+			logger.error('Failed to delete %s: %s' % (item.name(), e))
+		for (collection, key), e in created.errors:
+			logger.error('Failed to create %s in %s: %s' % (key_name(key), collection.id(), e))
+		return PlanResult(created_collections, created, deleted)
+
+
+def plan_topic(topic, desired, collection, actual):
+	'''
+	Compares the desired keys of a topic with its actual inputs.
+	'''
+	actual_keys = {}
+	for item in actual:
+		actual_keys.setdefault(input_key(item), []).append(item)
+	create = sorted(desired.difference(actual_keys))
+	delete = [item for key in actual_keys if key not in desired for item in actual_keys[key]]
+	unchanged = len(desired) - len(create)
+	return TopicPlan(topic, desired, collection, create, delete, unchanged)
+
+
+def plan(config, collections, inputs):
+	'''
+	Builds the Plan for a topics configuration from a collections and an
+	inputs Snapshot.
+	'''
+	topics = []
+	for topic, desired in sorted(desired_state(config).items()):
+		collection = collections.find(topic)
+		actual = inputs.select('collectionId', collection.id()) if collection else []
+		topics.append(plan_topic(topic, desired, collection, actual))
+	return Plan(topics)
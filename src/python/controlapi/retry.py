@@ -0,0 +1,114 @@
+import random
+import threading
+import time
+import email.utils
+
+idempotent_methods = ('GET', 'DELETE', 'PATCH', 'PUT', 'HEAD', 'OPTIONS')
+retry_statuses = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value):
+	'''
+	Seconds to wait according to a Retry-After header, which is either a
+	number of seconds or an HTTP date. None if absent or unparsable.
+	'''
+	if not value:
+		return None
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		pass
+	parsed = email.utils.parsedate_tz(value)
+	if parsed is None:
+		return None
+	return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class RetryPolicy(object):
+	'''
+	Decides which failed requests are retried and how long to wait.
+
+	Idempotent methods are retried on connection errors and on statuses;
+	POST only when the caller passed a dedupe key. Waits follow
+	Retry-After when the server sends it and jittered exponential backoff
+	(up to max_backoff) otherwise. A Retry-After longer than max_retry_after
+	is not shortened; the request fails instead.
+	'''
+	def __init__(self, max_retries=5, backoff=0.5, max_backoff=30.0, statuses=retry_statuses, methods=idempotent_methods, max_retry_after=300.0):
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.statuses = statuses
+		self.methods = methods
+		self.max_retry_after = max_retry_after
+
+	def can_retry(self, method, attempt, dedupe=False, retry_after=None):
+		if attempt >= self.max_retries:
+			return False
+		if retry_after is not None and retry_after > self.max_retry_after:
+			return False
+		return method in self.methods or dedupe
+
+	def retry_status(self, status):
+		return status in self.statuses
+
+	def delay(self, attempt, retry_after=None):
+		if retry_after is not None:
+			return retry_after
+		return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+
+class RateLimiter(object):
+	'''
+	Token bucket that adapts its rate to the server (additive increase,
+	multiplicative decrease).
+
+	reserve() takes a token and returns how long the caller has to wait
+	before sending, so it serves both threads and asyncio tasks. throttled()
+	is called on a 429 and halves the rate, optionally pausing everyone for
+	Retry-After seconds; succeeded() raises the rate again by increase per
+	second of successful traffic, up to max_rate.
+	'''
+	def __init__(self, rate=20.0, burst=None, min_rate=1.0, max_rate=200.0, increase=1.0):
+		self.rate = float(rate)
+		self.burst = float(burst or max(rate, 1))
+		self.min_rate = min_rate
+		self.max_rate = max_rate
+		self.increase = increase
+		self._tokens = self.burst
+		self._updated = time.time()
+		self._paused_until = 0.0
+		self._lock = threading.Lock()
+
+	def _refill(self, now):
+		self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	def reserve(self):
+		with self._lock:
+			now = time.time()
+			self._refill(now)
+			self._tokens -= 1
+			wait = 0.0
+			if self._tokens < 0:
+				wait = -self._tokens / self.rate
+			return max(wait, self._paused_until - now)
+
+	def acquire(self):
+		wait = self.reserve()
+		if wait > 0:
+			time.sleep(wait)
+
+	def throttled(self, retry_after=None):
+		with self._lock:
+			self.rate = max(self.min_rate, self.rate / 2)
+			self.burst = max(1.0, min(self.burst, self.rate))
+			self._tokens = min(self._tokens, 0.0)
+			if retry_after:
+				self._paused_until = max(self._paused_until, time.time() + retry_after)
+
+	def succeeded(self):
+		with self._lock:
+			if self.rate < self.max_rate:
+				self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+				self.burst = max(self.burst, self.rate)
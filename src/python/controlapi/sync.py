@@ -0,0 +1,124 @@
+'''
+Incremental topics sync.
+
+A SyncState file remembers, per topic, a hash of its desired inputs and the
+id of the collection it was last synced to. Only topics whose hash changed,
+that are new, or whose collection disappeared remotely are reconciled, and
+only their collections' inputs are fetched. Inputs changed or deleted
+remotely in an otherwise unchanged topic are not noticed; a sync without a
+state file (or watch mode's drift check) repairs those.
+'''
+import os
+import json
+import hashlib
+import tempfile
+import logging
+
+import controlapi.client as client
+import controlapi.reconcile as reconcile
+
+logger = logging.getLogger(__name__)
+
+
+def topic_hash(keys):
+	return hashlib.sha1(json.dumps(sorted(keys)).encode('utf-8')).hexdigest()
+
+
+class SyncState(object):
+	def __init__(self, path):
+		self.path = path
+		self.topics = {}
+		if os.path.exists(path):
+			with open(path) as f:
+				self.topics = json.load(f).get('topics', {})
+
+	def save(self):
+		directory = os.path.dirname(self.path) or '.'
+		fd, tmp = tempfile.mkstemp(dir=directory)
+		try:
+			with os.fdopen(fd, 'w') as f:
+				json.dump({'topics': self.topics}, f, indent=1, sort_keys=True)
+			os.rename(tmp, self.path)
+		except Exception:
+			os.unlink(tmp)
+			raise
+
+	def get(self, topic):
+		return self.topics.get(topic)
+
+	def record(self, topic, keys, collection):
+		self.topics[topic] = {
+			'hash': topic_hash(keys),
+			'collection_id': collection.id()
+		}
+
+	def forget(self, topic):
+		self.topics.pop(topic, None)
+
+
+def stale_topics(desired, state, collections):
+	'''
+	Topics that need reconciling: new or edited ones and those whose
+	collection no longer exists.
+	'''
+	stale = []
+	for topic, keys in sorted(desired.items()):
+		entry = state.get(topic)
+		if entry is None or entry['hash'] != topic_hash(keys):
+			stale.append(topic)
+		elif collections.get(entry['collection_id']) is None:
+			logger.warn('Collection of %s is gone, resyncing' % topic)
+			stale.append(topic)
+	return stale
+
+
+def collection_inputs(inputs_factory, collection_ids):
+	'''
+	The inputs of the given collections, from one filtered listing each.
+	When the server turns out to ignore the collectionId filter, the first
+	listing already holds every input and serves all the collections.
+	'''
+	wanted = set(collection_ids)
+	items = []
+	for collection_id in collection_ids:
+		listed = list(inputs_factory.iter(params={'collectionId': collection_id}))
+		if any(item.data.get('collectionId') != collection_id for item in listed):
+			logger.warn('The server ignores the collectionId filter, using one full inputs listing')
+			return [item for item in listed if item.data.get('collectionId') in wanted]
+		items.extend(listed)
+	return items
+
+
+def plan(config, state, collections, inputs_factory):
+	'''
+	Builds a reconcile.Plan covering only the stale topics. collections is a
+	collections Snapshot; the inputs of the stale topics' collections are
+	fetched into a new inputs Snapshot, returned along with the plan.
+	'''
+	desired = reconcile.desired_state(config)
+	for topic in list(state.topics):
+		if topic not in desired:
+			state.forget(topic)
+	topics = stale_topics(desired, state, collections)
+	found = [collections.find(topic) for topic in topics]
+	items = collection_inputs(inputs_factory, [collection.id() for collection in found if collection is not None])
+	inputs = client.Snapshot(inputs_factory, inputs_factory.index_fields, items)
+	subset = {
+		'services': config['services'],
+		'topics': dict((topic, config['topics'][topic]) for topic in topics)
+	}
+	return reconcile.plan(subset, collections, inputs), inputs
+
+
+def record(plan, result, state):
+	'''
+	Stores the synced state of the topics of an executed plan. Topics with
+	failed changes are left out so the next run retries them.
+	'''
+	failed = set(item.data['collectionId'] for item, e in result.deleted.errors)
+	failed.update(collection.id() for (collection, key), e in result.created.errors)
+	for topic in plan.topics:
+		if topic.collection is None or topic.collection.id() in failed:
+			state.forget(topic.topic)
+			continue
+		state.record(topic.topic, topic.desired, topic.collection)
@@ -0,0 +1,193 @@
+'''
+Long running topics sync.
+
+TopicsDaemon keeps a Control (with its pooled transport and refreshed
+token) and snapshots of the contract's collections and inputs in memory.
+When the topics file changes, the new configuration is planned against the
+snapshots and only the differences are applied, without listing anything.
+A periodic drift check refreshes the snapshots from the API, which costs
+little when the transport has a response cache and nothing changed, and
+re-applies the configuration if someone changed the contract remotely.
+'''
+import os
+import json
+import time
+import logging
+
+import controlapi.bulk as bulk
+import controlapi.client as client
+import controlapi.reconcile as reconcile
+import controlapi.sync as sync
+
+try:
+	from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+	INotify = None
+
+logger = logging.getLogger(__name__)
+
+
+class FileWatcher(object):
+	'''
+	Waits for changes to one file. Uses inotify (through inotify_simple)
+	on the file's directory when available, so replacing the file by a
+	rename is seen too, and polls its size and mtime otherwise.
+	'''
+	def __init__(self, path, interval=1.0, inotify=True):
+		self.path = os.path.abspath(path)
+		self.interval = interval
+		self._signature = self._stat()
+		self._inotify = None
+		if inotify and INotify is not None:
+			try:
+				self._inotify = INotify()
+				self._inotify.add_watch(os.path.dirname(self.path),
+					inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE)
+			except OSError as e:
+				logger.warn('inotify unavailable (%s), polling %s', e, self.path)
+				self._inotify = None
+
+	def polling(self):
+		return self._inotify is None
+
+	def _stat(self):
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			return None
+		return (st.st_ino, st.st_size, st.st_mtime)
+
+	def wait(self, timeout):
+		'''
+		Blocks for up to timeout seconds and tells whether the file changed.
+		'''
+		deadline = time.time() + timeout
+		if self._inotify is not None:
+			name = os.path.basename(self.path)
+			while True:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return False
+				events = self._inotify.read(timeout=int(remaining * 1000))
+				if any(event.name == name for event in events):
+					self._signature = self._stat()
+					return True
+		while True:
+			signature = self._stat()
+			if signature != self._signature:
+				self._signature = signature
+				return True
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return False
+			time.sleep(min(self.interval, remaining))
+
+	def close(self):
+		if self._inotify is not None:
+			self._inotify.close()
+			self._inotify = None
+
+
+class TopicsDaemon(object):
+	'''
+	Keeps a contract in sync with a topics file until stop() is called.
+
+	Changes are applied debounce seconds after the last write to the file
+	and the snapshots are checked for drift every drift_interval seconds.
+	With a state file the synced topics are recorded after every change so
+	one-off incremental runs can pick up where the daemon left off.
+	'''
+	def __init__(self, control, topics_file, concurrency=bulk.default_concurrency, drift_interval=300, debounce=0.5, state_path=None, watcher=None):
+		self.control = control
+		self.topics_file = topics_file
+		self.concurrency = concurrency
+		self.drift_interval = drift_interval
+		self.debounce = debounce
+		self.state = sync.SyncState(state_path) if state_path else None
+		self.watcher = watcher or FileWatcher(topics_file)
+		self.config = None
+		self.collections = None
+		self.inputs = None
+		self._stopped = False
+		self._next_check = 0
+
+	def load(self):
+		'''
+		Reads the topics file; None when it is missing or not valid JSON,
+		which happens briefly while an editor saves it.
+		'''
+		try:
+			with open(self.topics_file) as f:
+				config = json.load(f)
+		except (IOError, ValueError) as e:
+			logger.warn('Could not read %s: %s', self.topics_file, e)
+			return None
+		if 'services' not in config or 'topics' not in config:
+			logger.warn('%s has no services or topics', self.topics_file)
+			return None
+		return config
+
+	def start(self):
+		self.collections = client.CollectionFactory(self.control).snapshot()
+		self.inputs = client.InputFactory(self.control).snapshot()
+		self._next_check = time.time() + self.drift_interval
+		config = self.load()
+		if config is None:
+			raise ValueError('Invalid topics file %s' % self.topics_file)
+		self.apply(config)
+
+	def apply(self, config):
+		'''
+		Plans config against the snapshots and executes the changes.
+		'''
+		plan = reconcile.plan(config, self.collections, self.inputs)
+		self.config = config
+		if not plan.changes():
+			logger.info('No changes')
+			return None
+		logger.warn(plan.summary())
+		result = plan.execute(self.collections, self.inputs, self.concurrency)
+		logger.warn(result.summary())
+		if self.state is not None:
+			sync.record(plan, result, self.state)
+			self.state.save()
+		return result
+
+	def check_drift(self):
+		'''
+		Refreshes the snapshots from the API and re-applies the current
+		configuration if they no longer match it.
+		'''
+		self._next_check = time.time() + self.drift_interval
+		self.collections.refresh()
+		self.inputs.refresh()
+		return self.apply(self.config)
+
+	def reload(self):
+		config = self.load()
+		if config is None or config == self.config:
+			return None
+		logger.warn('%s changed', self.topics_file)
+		return self.apply(config)
+
+	def run_forever(self):
+		if self.config is None:
+			self.start()
+		logger.warn('Watching %s%s', self.topics_file, ' (polling)' if self.watcher.polling() else '')
+		while not self._stopped:
+			timeout = max(self._next_check - time.time(), 0)
+			try:
+				if self.watcher.wait(min(timeout, 1.0)):
+					while self.watcher.wait(self.debounce):
+						pass
+					self.reload()
+				elif time.time() >= self._next_check:
+					self.check_drift()
+			except Exception as e:
+				# keep the daemon alive; the next change or drift check retries
+				logger.exception(e)
+				self._next_check = time.time() + self.drift_interval
+		self.watcher.close()
+
+	def stop(self):
+		self._stopped = True
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
+
+from .frigg import Frigg, HTTPException
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncFrigg(Frigg):
+	"""
+	Frigg for asyncio (Python 3.5+, requires aiohttp).
+
+	token() is a coroutine. Only one request or refresh is in flight at a
+	time, concurrent tasks wait for its result, and the background refresh
+	runs as a task on the event loop instead of a timer thread.
+	"""
+
+	def __init__(self, configuration, session=None):
+		if aiohttp is None:
+			raise ImportError('AsyncFrigg requires aiohttp')
+		Frigg.__init__(self, configuration)
+		self._session = session
+		self._own_session = session is None
+		self._async_lock = None
+		self._task = None
+
+
+	async def token(self):
+		"""
+		Obtains an access token on behalf of an OAuth Consumer identified by
+		the previously initialized credentials.
+		"""
+		token = self._valid_token()
+		if token:
+			return token
+
+		if self._async_lock is None:
+			self._async_lock = asyncio.Lock()
+		async with self._async_lock:
+			# callers that queued behind a refresh find its token published
+			token = self._valid_token()
+			if token:
+				return token
+			if self._load_stored():
+				return self._published[0]
+			if self._refresh_token:
+				await self._refresh_async()
+			else:
+				await self._request_async()
+			return self._published[0] if self._published else None
+
+
+	def close(self):
+		"""
+		Stops the background refresh task.
+		"""
+		self._background_refresh = False
+		if self._task:
+			self._task.cancel()
+			self._task = None
+
+
+	async def aclose(self):
+		"""
+		Stops the background refresh task and closes the HTTP session.
+		"""
+		self.close()
+		if self._session and self._own_session:
+			await self._session.close()
+			self._session = None
+
+
+	def _http(self):
+		if self._session is None or self._session.closed:
+			self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self._request_timeout))
+			self._own_session = True
+		return self._session
+
+
+	async def _request_async(self):
+		result = await self._token_post_request_async({
+			'grant_type': 'client_credentials'
+		})
+		await self._handle_token_response_async(result)
+
+
+	async def _refresh_async(self):
+		options = {
+			'grant_type': 'refresh_token',
+			'refresh_token': self._refresh_token
+		}
+		try:
+			result = await self._token_post_request_async(options)
+			await self._handle_token_response_async(result)
+		except HTTPException as e:
+			_logger.exception(e)
+			if e.status_code == 400:
+				await self._request_async()
+
+
+	async def _token_post_request_async(self, payload):
+		uri = self._auth_server_uri + '/oauth/token'
+		headers = {
+			'Authorization': 'Basic ' + self._encode_credentials()
+		}
+		self._stats['token_requests'] += 1
+		async with self._http().post(uri, data=payload, headers=headers) as response:
+			if response.status != 200:
+				_logger.error(response)
+				raise HTTPException(response.status, uri, data=payload, headers=headers, response=response)
+			return await response.json(content_type=None)
+
+
+	async def _handle_token_response_async(self, data):
+		if not self._accept_token_response(data):
+			self._accept_token_info(await self._request_token_info_async())
+		self._publish()
+		self._save_stored()
+		self._schedule_refresh()
+
+
+	async def _request_token_info_async(self):
+		uri = self._auth_server_uri + '/oauth/token/info'
+		payload = {
+			'access_token': self._access_token
+		}
+		headers = {
+			'Authorization': 'Basic ' + self._encode_credentials()
+		}
+		self._stats['info_requests'] += 1
+		try:
+			async with self._http().get(uri, data=payload, headers=headers) as response:
+				if response.status != 200:
+					_logger.error(response)
+					raise Exception('Server did not respond as expected. HTTP status code %s' % response.status)
+				return await response.json(content_type=None)
+		except asyncio.TimeoutError:
+			raise Exception('Server timed out')
+
+
+	def _schedule_refresh(self):
+		"""
+		Arms the background refresh task for the current token.
+		"""
+		if not self._background_refresh:
+			return
+		if self._task:
+			self._task.cancel()
+			self._task = None
+		seconds = self._refresh_delay()
+		if seconds <= 0:
+			return
+		self._task = asyncio.ensure_future(self._background_refresh_task(seconds))
+
+
+	async def _background_refresh_task(self, seconds):
+		await asyncio.sleep(seconds)
+		# this task is done with its timer, do not let a reschedule cancel it
+		self._task = None
+		if self._async_lock is None:
+			self._async_lock = asyncio.Lock()
+		async with self._async_lock:
+			try:
+				if self._load_stored() and not self._token_expires_within_offset(self._refresh_lead):
+					return
+				await self._refresh_async()
+			except Exception as e:
+				# token() falls back to refreshing inline
+				_logger.exception(e)
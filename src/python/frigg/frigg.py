@@ -1,20 +1,44 @@
  #!/usr/bin/env python
 
 import requests
-import urllib
 import base64
 import datetime
 import logging
 import copy
+import threading
+import time
+import atexit
+import weakref
 
 from dateutil.parser import parse
 
+from .store import FileTokenStore
+
+try:
+	from urllib import quote
+except ImportError:
+	from urllib.parse import quote
+
+try:
+	basestring
+except NameError:
+	basestring = str
+
 # pylint: disable=old-style-class
 # pylint: disable=invalid-name
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
+# Background refresh timers are cancelled at exit so they do not fire while
+# the interpreter shuts down.
+_instances = weakref.WeakSet()
+
+@atexit.register
+def _close_all():
+	for frigg in list(_instances):
+		frigg.close()
+
 class HTTPException(Exception):
 	def __init__(self, status_code, uri, data=None, headers=None, response=None):
 		Exception.__init__(self, str(status_code) + ' on ' + uri)
@@ -36,8 +60,19 @@ class Frigg:
 
 		Optionally the Authorization Server version, access token expiration
 		offset and recursion limit safeguard can be provided.
+
+		Unless backgroundRefresh is False the token pair is refreshed on a
+		daemon timer refreshLead milliseconds before the expiration offset
+		is reached, so callers of token() do not block on the auth server.
+
+		A tokenStore (an object with load/save/delete, or a file path for a
+		FileTokenStore) lets processes reuse a still valid token pair
+		instead of requesting a new one.
+
+		requestTimeout bounds each auth server request, in milliseconds.
 		"""
-		configuration = copy.deepcopy(configuration)
+		token_store = configuration.get('tokenStore')
+		configuration = copy.deepcopy(dict((k, v) for k, v in configuration.items() if k != 'tokenStore'))
 		_logger.warn(configuration)
 		mandatory_keys = ['clientId', 'clientSecret', 'authServerDomain']
 		missing_keys = list(set(mandatory_keys) - set(configuration.keys()))
@@ -53,30 +88,154 @@ class Frigg:
 
 		if not 'recursionLimit' in configuration:
 			configuration['recursionLimit'] = 3
+		if not 'backgroundRefresh' in configuration:
+			configuration['backgroundRefresh'] = True
+		if not 'refreshLead' in configuration:
+			configuration['refreshLead'] = 60000
+		if not 'requestTimeout' in configuration:
+			configuration['requestTimeout'] = 30000
 
 		self._client_id = configuration['clientId']
 		self._client_secret = configuration['clientSecret']
 		self._auth_server_uri = configuration['authServerDomain'] + '/' + configuration['authServerVersion']
 		self._expiration_offset = configuration['expirationOffset']
 		self._retry_limit = configuration['recursionLimit']
+		self._background_refresh = configuration['backgroundRefresh']
+		self._refresh_lead = datetime.timedelta(milliseconds=configuration['refreshLead'])
+		self._request_timeout = configuration['requestTimeout'] / 1000.0
+		if isinstance(token_store, basestring):
+			token_store = FileTokenStore(token_store)
+		self._token_store = token_store
+		self._store_key = self._client_id + '@' + self._auth_server_uri
 
 		self._access_token = None
 		self._refresh_token = None
 		self._expires = None
+		# (access token, expires), replaced as a whole once both are known
+		self._published = None
+
+		self._lock = threading.Lock()
+		self._timer = None
+		self._timer_lock = threading.Lock()
+		_instances.add(self)
+
+		self._stats = {
+			'token_requests': 0,
+			'info_requests': 0,
+			'round_trips_saved': 0
+		}
 
 
 	def token(self):
 		"""
 		Obtains an access token on behalf of an OAuth Consumer identified by
 		the previously initialized credentials.
+
+		Safe to call from several threads: only one request or refresh is in
+		flight at a time and concurrent callers wait for its result.
+		"""
+		token = self._valid_token()
+		if token:
+			return token
+
+		with self._lock:
+			# callers that queued behind a refresh find its token published
+			token = self._valid_token()
+			if token:
+				return token
+			if self._load_stored():
+				return self._published[0]
+			if self._refresh_token:
+				self._refresh()
+			else:
+				self._request()
+			return self._published[0] if self._published else None
+
+
+	def _valid_token(self):
+		"""
+		The published access token when it is valid beyond the expiration
+		offset, None otherwise. Reads token and expiry together, so it can be
+		called without the lock while a new token is being obtained.
+		"""
+		published = self._published
+		if published and published[1] - datetime.datetime.now() >= self._expiration_offset:
+			return published[0]
+		return None
+
+
+	def _publish(self):
+		self._published = (self._access_token, self._expires)
+
+
+	def stats(self):
+		"""
+		Counts of auth server round trips made and saved, the latter by
+		expires_in in token responses and by token store hits.
+		"""
+		return dict(self._stats)
+
+
+	def _load_stored(self):
 		"""
-		if not self._access_token:
-			self._request()
-		if not self._token_expires_within_offset():
-			return self._access_token
+		Adopts the token pair from the token store when it is valid beyond
+		the expiration offset, or just its refresh token otherwise.
+		"""
+		if not self._token_store:
+			return False
+		try:
+			entry = self._token_store.load(self._store_key)
+		except Exception as e:
+			_logger.exception(e)
+			return False
+		if not entry:
+			return False
+		if not self._refresh_token or entry['expires'] > self._expires_timestamp():
+			self._refresh_token = entry['refresh_token']
+		expires = datetime.datetime.fromtimestamp(entry['expires'])
+		if expires - datetime.datetime.now() < self._expiration_offset:
+			return False
+		if self._access_token != entry['access_token']:
+			self._stats['round_trips_saved'] += 2
+		self._access_token = entry['access_token']
+		self._expires = expires
+		self._publish()
+		self._schedule_refresh()
+		return True
+
+
+	def _save_stored(self):
+		if not self._token_store:
+			return
+		try:
+			self._token_store.save(self._store_key, {
+				'access_token': self._access_token,
+				'refresh_token': self._refresh_token,
+				'expires': self._expires_timestamp()
+			})
+		except Exception as e:
+			_logger.exception(e)
+
 
-		self._refresh()
-		return self._access_token
+	def _expires_timestamp(self):
+		if not self._expires:
+			return 0
+		return time.mktime(self._expires.timetuple()) + self._expires.microsecond / 1e6
+
+
+	def close(self):
+		"""
+		Stops the background refresh timer. A refresh already running on it is
+		not waited for; the timer thread is a daemon.
+		"""
+		self._background_refresh = False
+		with self._timer_lock:
+			timer = self._timer
+			self._timer = None
+			if timer:
+				timer.cancel()
+		if timer and timer is not threading.current_thread():
+			timer.join()
 
 
 	def ttl(self):
@@ -131,7 +290,8 @@ class Frigg:
 		headers = {
 			'Authorization': 'Basic ' + self._encode_credentials()
 		}
-		response = requests.post(uri, data=payload, headers=headers)
+		self._stats['token_requests'] += 1
+		response = requests.post(uri, data=payload, headers=headers, timeout=self._request_timeout)
 		if response.status_code != 200:
 			_logger.error(response)
 			raise HTTPException(response.status_code, uri, data=payload, headers=headers, response=response)
@@ -143,8 +303,23 @@ class Frigg:
 		Returns an request handler that handles the http request made when
 		requesting or refreshing tokens.
 
+		The expiry is taken from expires_in when the server sends it, the
+		token info endpoint is only asked otherwise.
+
 		Note that this handler is only used when requesting/refreshing tokens.
 		"""
+		if not self._accept_token_response(data):
+			self._get_info()
+		self._publish()
+		self._save_stored()
+		self._schedule_refresh()
+
+
+	def _accept_token_response(self, data):
+		"""
+		Takes over the token pair of a token response. Returns whether the
+		response also told when the access token expires.
+		"""
 		if not data:
 			raise Exception('no data provided')
 		if not 'access_token' in data:
@@ -154,7 +329,54 @@ class Frigg:
 
 		self._access_token = data['access_token']
 		self._refresh_token = data['refresh_token']
-		self._get_info()
+		if not 'expires_in' in data:
+			return False
+		self._expires = datetime.datetime.now() + datetime.timedelta(seconds=data['expires_in'])
+		self._stats['round_trips_saved'] += 1
+		return True
+
+
+	def _schedule_refresh(self):
+		"""
+		Arms the background refresh timer for the current token.
+		"""
+		if not self._background_refresh:
+			return
+		with self._timer_lock:
+			if self._timer:
+				self._timer.cancel()
+			seconds = self._refresh_delay()
+			if seconds <= 0:
+				self._timer = None
+				return
+			self._timer = threading.Timer(seconds, self._background_refresh_run)
+			self._timer.daemon = True
+			self._timer.start()
+
+
+	def _refresh_delay(self):
+		"""
+		Seconds until the background refresh should run.
+		"""
+		delay = self.ttl() - self._expiration_offset - self._refresh_lead
+		return delay.days * 86400 + delay.seconds + delay.microseconds / 1e6
+
+
+	def _background_refresh_run(self):
+		with self._timer_lock:
+			if threading.current_thread().finished.is_set():
+				# cancelled while firing
+				return
+			# fired, so close() does not wait for the refresh
+			self._timer = None
+		with self._lock:
+			try:
+				if self._load_stored() and not self._token_expires_within_offset(self._refresh_lead):
+					return
+				self._refresh()
+			except Exception as e:
+				# token() falls back to refreshing inline
+				_logger.exception(e)
 
 
 	def _request_token_info(self):
@@ -168,8 +390,9 @@ class Frigg:
 		headers = {
 			'Authorization': 'Basic ' + self._encode_credentials()
 		}
+		self._stats['info_requests'] += 1
 		try:
-			response = requests.get(uri, data=payload, headers=headers)
+			response = requests.get(uri, data=payload, headers=headers, timeout=self._request_timeout)
 		except requests.Timeout:
 			raise Exception('Server timed out')
 		if response.status_code != 200:
@@ -179,18 +402,21 @@ class Frigg:
 
 
 	def _get_info(self):
-		info = self._request_token_info()
+		self._accept_token_info(self._request_token_info())
+
+
+	def _accept_token_info(self, info):
 		if not 'ttl' in info:
 			raise Exception('Token has no ttl.')
 		self._expires = datetime.datetime.now() + datetime.timedelta(milliseconds=info['ttl'])
 
 
-	def _token_expires_within_offset(self):
+	def _token_expires_within_offset(self, lead=datetime.timedelta(0)):
 		"""
 		Determines if the access token expires within the specified expiration
 		offset.
 		"""
-		return self.ttl() < self._expiration_offset
+		return self.ttl() < self._expiration_offset + lead
 
 
 	def _encode_credentials(self):
@@ -201,10 +427,10 @@ class Frigg:
 
 		return Object base64
 		"""
-		encoded = urllib.quote(self._client_id) + ':' + \
-			urllib.quote(self._client_secret)
+		encoded = quote(self._client_id) + ':' + \
+			quote(self._client_secret)
 
-		return base64.b64encode(encoded)
+		return base64.b64encode(encoded.encode('utf-8')).decode('ascii')
 
 
 	def __str__(self):
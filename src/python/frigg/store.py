@@ -0,0 +1,122 @@
+import os
+import json
+import errno
+import fcntl
+import tempfile
+import threading
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class MemoryTokenStore(object):
+	"""
+	Keeps token entries in process memory. Shares tokens between Frigg
+	instances of one process.
+	"""
+
+	def __init__(self):
+		self._entries = {}
+		self._lock = threading.Lock()
+
+
+	def load(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			return dict(entry) if entry else None
+
+
+	def save(self, key, entry):
+		with self._lock:
+			self._entries[key] = dict(entry)
+
+
+	def delete(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+
+
+class FileTokenStore(object):
+	"""
+	Keeps token entries in a JSON file shared by all processes of a user.
+
+	Readers take a shared and writers an exclusive flock on a sidecar lock
+	file; the data file is replaced atomically and only readable by its
+	owner.
+	"""
+
+	def __init__(self, path=None):
+		if path is None:
+			path = os.path.join(os.path.expanduser('~'), '.frigg', 'tokens.json')
+		self._path = path
+		self._lock_path = path + '.lock'
+		directory = os.path.dirname(path)
+		if directory:
+			try:
+				os.makedirs(directory, 0o700)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+
+
+	def _locked(self, mode):
+		fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+		fcntl.flock(fd, mode)
+		return fd
+
+
+	def _unlock(self, fd):
+		fcntl.flock(fd, fcntl.LOCK_UN)
+		os.close(fd)
+
+
+	def _read(self):
+		try:
+			with open(self._path) as f:
+				return json.load(f)
+		except IOError as e:
+			if e.errno != errno.ENOENT:
+				raise
+		except ValueError as e:
+			_logger.warn('Ignoring corrupt token store %s: %s', self._path, e)
+		return {}
+
+
+	def _write(self, entries):
+		directory = os.path.dirname(self._path) or '.'
+		fd, tmp = tempfile.mkstemp(dir=directory)
+		try:
+			with os.fdopen(fd, 'w') as f:
+				json.dump(entries, f)
+			os.rename(tmp, self._path)
+		except Exception:
+			os.unlink(tmp)
+			raise
+
+
+	def load(self, key):
+		fd = self._locked(fcntl.LOCK_SH)
+		try:
+			return self._read().get(key)
+		finally:
+			self._unlock(fd)
+
+
+	def save(self, key, entry):
+		fd = self._locked(fcntl.LOCK_EX)
+		try:
+			entries = self._read()
+			entries[key] = entry
+			self._write(entries)
+		finally:
+			self._unlock(fd)
+
+
+	def delete(self, key):
+		fd = self._locked(fcntl.LOCK_EX)
+		try:
+			entries = self._read()
+			if entries.pop(key, None) is not None:
+				self._write(entries)
+		finally:
+			self._unlock(fd)
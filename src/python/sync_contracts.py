@@ -0,0 +1,195 @@
+'''
+Syncs the topics of many contracts in parallel.
+
+The manifest is a JSON file listing the contracts; keys missing from a
+contract are taken from "defaults", and relative paths are resolved against
+the manifest's directory:
+
+	{
+		"defaults": {"client_id": "...", "client_secret": "...", "concurrency": 8},
+		"contracts": [
+			{"contract_id": "...", "topics_file": "a/topics.json", "state": "a/state.json"},
+			{"contract_id": "...", "topics_file": "b/topics.json", "concurrency": 2}
+		]
+	}
+
+Contract keys: contract_id, client_id, client_secret, topics_file and
+optionally concurrency (the per-contract cap on concurrent API calls),
+state, token_store, api_url and auth_server.
+
+Contracts are spread over a process pool. Every worker keeps one pooled
+transport and one Frigg per client for all contracts it syncs, and a
+semaphore shared by the workers caps the API calls in flight overall.
+'''
+import controlapi.client as client
+import controlapi.bulk as bulk
+import controlapi.json_http as http
+import controlapi.metrics as metrics
+import update_topics
+import multiprocessing
+import logging
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+required_keys = ('contract_id', 'client_id', 'client_secret', 'topics_file')
+path_keys = ('topics_file', 'state', 'token_store')
+
+def load_manifest(path):
+	with open(path) as f:
+		manifest = json.load(f)
+	base = os.path.dirname(os.path.abspath(path))
+	jobs = []
+	for contract in manifest['contracts']:
+		job = dict(manifest.get('defaults', {}))
+		job.update(contract)
+		missing = [key for key in required_keys if not job.get(key)]
+		if missing:
+			raise ValueError('Contract %s is missing %s' % (job.get('contract_id'), ', '.join(missing)))
+		for key in path_keys:
+			if job.get(key):
+				job[key] = os.path.join(base, job[key])
+		jobs.append(job)
+	return jobs
+
+def job_concurrency(job):
+	return job.get('concurrency') or bulk.default_concurrency
+
+
+_worker = {}
+
+def _init_worker(semaphore, pool_maxsize):
+	_worker['transport'] = http.Transport(pool_maxsize=pool_maxsize, semaphore=semaphore)
+	_worker['friggs'] = {}
+
+def _frigg(job):
+	auth_server = job.get('auth_server') or update_topics.auth_server
+	key = (job['client_id'], auth_server)
+	if key not in _worker['friggs']:
+		_worker['friggs'][key] = update_topics.get_frigg(job['client_id'], job['client_secret'], job.get('token_store'), auth_server)
+	return _worker['friggs'][key]
+
+def sync_contract(job):
+	'''
+	Syncs one contract in a worker and returns a picklable report.
+	'''
+	start = time.time()
+	report = {'contract_id': job['contract_id'], 'pid': os.getpid(), 'ok': False}
+	collected = metrics.Metrics()
+	try:
+		control = update_topics.get_control(
+			job['contract_id'], job['client_id'], job['client_secret'],
+			_worker['transport'],
+			instruments=metrics.Instruments(collected),
+			base_url=job.get('api_url') or client.base_url,
+			frigg=_frigg(job)
+		)
+		with open(job['topics_file']) as f:
+			config = json.load(f)
+		plan, result, collections, inputs = update_topics.sync_topics(control, config, job_concurrency(job), job.get('state'), job.get('dry_run'))
+		report['plan'] = plan.summary()
+		if result is None:
+			report['ok'] = True
+			report['changes'] = plan.dry_run()
+		else:
+			report['ok'] = result.ok()
+			report['result'] = result.summary()
+	except Exception as e:
+		logger.exception(e)
+		report['error'] = str(e)
+	report['elapsed'] = time.time() - start
+	report['requests'] = collected.requests()
+	report['metrics'] = collected.export()
+	return report
+
+
+class RunReport(object):
+	def __init__(self, reports, elapsed):
+		self.reports = sorted(reports, key=lambda report: report['contract_id'])
+		self.elapsed = elapsed
+
+	def ok(self):
+		return all(report['ok'] for report in self.reports)
+
+	def failed(self):
+		return [report for report in self.reports if not report['ok']]
+
+	def metrics(self):
+		merged = metrics.Metrics()
+		for report in self.reports:
+			merged.merge(report['metrics'])
+		return merged
+
+	def summary(self):
+		requests = sum(report['requests'] for report in self.reports)
+		return '%d contracts, %d failed, %d requests in %.2fs' % (len(self.reports), len(self.failed()), requests, self.elapsed)
+
+	def format(self):
+		lines = []
+		for report in self.reports:
+			status = 'ok' if report['ok'] else 'FAILED'
+			detail = report.get('error') or report.get('result') or report.get('plan')
+			lines.append('%s %s %.2fs %d requests: %s' % (report['contract_id'], status, report['elapsed'], report['requests'], detail))
+			if report.get('changes'):
+				lines.append(report['changes'])
+		lines.append(self.summary())
+		return '\n'.join(lines)
+
+	def to_dict(self):
+		return {
+			'ok': self.ok(),
+			'elapsed': self.elapsed,
+			'contracts': [dict((k, v) for k, v in report.items() if k != 'metrics') for report in self.reports]
+		}
+
+
+def run(jobs, processes=None, max_concurrency=None):
+	'''
+	Syncs the contracts of jobs on a pool of processes (one per CPU by
+	default) with at most max_concurrency API calls in flight overall.
+	'''
+	start = time.time()
+	processes = max(1, min(processes or multiprocessing.cpu_count(), len(jobs)))
+	semaphore = multiprocessing.BoundedSemaphore(max_concurrency) if max_concurrency else None
+	pool_maxsize = max([job_concurrency(job) for job in jobs] + [1])
+	pool = multiprocessing.Pool(processes, _init_worker, (semaphore, pool_maxsize))
+	reports = []
+	try:
+		for report in pool.imap_unordered(sync_contract, jobs):
+			logger.warn('%s %s in %.2fs', report['contract_id'], 'synced' if report['ok'] else 'failed', report['elapsed'])
+			reports.append(report)
+		pool.close()
+	except BaseException:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+	return RunReport(reports, time.time() - start)
+
+if __name__ == "__main__":
+	import argparse
+	import sys
+
+	parser = argparse.ArgumentParser(description='Sync the topics of several contracts in parallel.')
+	parser.add_argument('manifest', help='JSON manifest of contracts and topics files')
+	parser.add_argument('--processes', type=int, help='Worker processes (default: one per CPU)')
+	parser.add_argument('--max-concurrency', type=int, help='Maximum number of API calls in flight over all contracts')
+	parser.add_argument('--dry-run', action='store_true', help='Print the changes without making them')
+	parser.add_argument('--report', help='Write the aggregated report as JSON to this file')
+	parser.add_argument('--metrics', help='Write the aggregated request metrics in the Prometheus text format to this file')
+
+	args = parser.parse_args()
+	jobs = load_manifest(args.manifest)
+	for job in jobs:
+		job['dry_run'] = args.dry_run or job.get('dry_run', False)
+
+	report = run(jobs, args.processes, args.max_concurrency)
+	print report.format()
+	if args.report:
+		with open(args.report, 'w') as f:
+			json.dump(report.to_dict(), f, indent=1, sort_keys=True)
+	if args.metrics:
+		report.metrics().write(args.metrics)
+	sys.exit(0 if report.ok() else 1)
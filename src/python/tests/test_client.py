@@ -0,0 +1,251 @@
+import threading
+import time
+import unittest
+
+import controlapi.bulk as bulk
+import controlapi.client as client
+
+try:
+	import asyncio
+	import controlapi.aio as aio
+except (ImportError, SyntaxError):
+	aio = None
+
+
+class RecordingControl(object):
+	asynchronous = False
+
+	def __init__(self):
+		self.patches = []
+
+	def patch(self, path, data):
+		self.patches.append((path, data))
+		return data
+
+
+class AsyncRecordingControl(RecordingControl):
+	asynchronous = True
+
+
+class BatchTest(unittest.TestCase):
+	def test_saves_and_direct_changes_are_sent_as_one_patch(self):
+		control = RecordingControl()
+		filter_list = client.FilterList(control, {'_id': 'f1', 'name': 'words', 'entries': ['a'], 'active': True})
+		with filter_list.batch():
+			filter_list.add('b')
+			filter_list.add_many(['c', 'd'])
+			filter_list.data['name'] = 'renamed'
+		self.assertEqual(control.patches, [('filter/lists/f1', {'entries': ['a', 'b', 'c', 'd'], 'name': 'renamed'})])
+
+	def test_nested_changes_to_data_are_detected(self):
+		control = RecordingControl()
+		filter_list = client.FilterList(control, {'_id': 'f1', 'entries': ['a']})
+		with filter_list.batch():
+			filter_list.data['entries'].append('b')
+		self.assertEqual(control.patches, [('filter/lists/f1', {'entries': ['a', 'b']})])
+
+	def test_unchanged_batch_sends_nothing(self):
+		control = RecordingControl()
+		filter_list = client.FilterList(control, {'_id': 'f1', 'entries': ['a']})
+		with filter_list.batch():
+			pass
+		self.assertEqual(control.patches, [])
+
+	def test_async_control_is_refused(self):
+		filter_list = client.FilterList(AsyncRecordingControl(), {'_id': 'f1', 'entries': []})
+		with self.assertRaises(TypeError):
+			with filter_list.batch():
+				filter_list.add('a')
+
+
+class SnapshotTest(unittest.TestCase):
+	def snapshot(self):
+		items = [client.Collection(None, {'_id': 'c%d' % i, 'name': 'dup' if i % 2 else 'c%d' % i, 'filterId': i % 3}) for i in range(6)]
+		return client.Snapshot(None, ('filterId',), items)
+
+	def test_indexes_follow_removals(self):
+		snapshot = self.snapshot()
+		self.assertEqual(snapshot.find('dup').id(), 'c1')
+		snapshot.remove('c1')
+		self.assertEqual(snapshot.find('dup').id(), 'c3')
+		snapshot.remove(snapshot.get('c3'))
+		snapshot.remove('c5')
+		self.assertIsNone(snapshot.find('dup'))
+		self.assertEqual([item.id() for item in snapshot.select('filterId', 0)], ['c0'])
+		self.assertEqual([item.id() for item in snapshot.list()], ['c0', 'c2', 'c4'])
+		self.assertEqual(len(snapshot), 3)
+		self.assertIsNone(snapshot.remove('c1'))
+
+	def test_add_replaces_the_item_with_the_same_id_in_place_of_order(self):
+		snapshot = self.snapshot()
+		snapshot.add(client.Collection(None, {'_id': 'c0', 'name': 'new', 'filterId': 2}))
+		self.assertEqual([item.id() for item in snapshot.list()], ['c1', 'c2', 'c3', 'c4', 'c5', 'c0'])
+		self.assertIsNone(snapshot.find('c0'))
+		self.assertEqual([item.id() for item in snapshot.select('filterId', 2)], ['c2', 'c5', 'c0'])
+		self.assertEqual([item.id() for item in snapshot.select('filterId', 0)], ['c3'])
+
+
+class ListingTransport(object):
+	'''
+	In memory collection listing. during_post, if set, runs in the middle
+	of the next post, like a write from another thread; posts take delay
+	seconds.
+	'''
+	def __init__(self, delay=0):
+		self.items = []
+		self.gets = 0
+		self.during_post = None
+		self.delay = delay
+		self.lock = threading.Lock()
+
+	def get(self, url, params=None):
+		self.gets += 1
+		return list(self.items)
+
+	def add(self, data):
+		with self.lock:
+			item = dict(data, _id='c%d' % len(self.items))
+			self.items.append(item)
+		during_post, self.during_post = self.during_post, None
+		if during_post:
+			during_post()
+		return item
+
+	def post(self, url, data):
+		item = self.add(data)
+		time.sleep(self.delay)
+		return item
+
+	def delete(self, url, data):
+		self.items = [item for item in self.items if not url.split('?')[0].endswith('/' + item['_id'])]
+
+
+class ListingControl(client.Control):
+	def __init__(self, delay=0):
+		client.Control.__init__(self, 'http://127.0.0.1:1/v1/', None, 'contract', transport=ListingTransport(delay))
+
+	def token(self):
+		return 'token'
+
+
+if aio is not None:
+	class AsyncListingTransport(ListingTransport):
+		def get(self, url, params=None):
+			return asyncio.sleep(0, result=ListingTransport.get(self, url, params))
+
+		def post(self, url, data):
+			return asyncio.sleep(self.delay, result=self.add(data))
+
+	class AsyncListingControl(aio.AsyncControl):
+		def __init__(self, delay=0):
+			aio.AsyncControl.__init__(self, 'http://127.0.0.1:1/v1/', None, 'contract', transport=AsyncListingTransport(delay))
+
+		def token(self):
+			return asyncio.sleep(0, result='token')
+
+
+class FactoryCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.control = ListingControl()
+		self.transport = self.control._http
+		self.factory = client.Factory('collection/collections', client.Collection, self.control).enable_cache()
+
+	def test_own_writes_keep_the_cache(self):
+		self.assertIsNone(self.factory.find('a'))
+		self.factory.create({'name': 'a'})
+		self.assertEqual(self.factory.find('a').id(), 'c0')
+		self.factory.delete_by_name('a')
+		self.assertIsNone(self.factory.find('a'))
+		self.assertEqual(self.transport.gets, 1)
+
+	def test_concurrent_writes_invalidate_the_cache(self):
+		self.factory.find('a')
+		self.transport.during_post = lambda: self.control.post('collection/collections', {'name': 'other'})
+		self.factory.create({'name': 'a'})
+		self.assertEqual(self.factory.find('other').id(), 'c1')
+		self.assertEqual(self.transport.gets, 2)
+
+	def test_concurrent_writes_during_create_list_invalidate_the_cache(self):
+		self.factory.find('a')
+		self.transport.during_post = lambda: self.control.post('collection/collections', {'name': 'other'})
+		created = self.factory.create_list([{'name': 'a'}, {'name': 'b'}], concurrency=1)
+		self.assertEqual([item.name() for item in created], ['a', 'b'])
+		self.assertEqual(self.factory.find('other').id(), 'c1')
+
+	def test_concurrent_creates_return_their_objects(self):
+		control = ListingControl(delay=0.01)
+		factory = client.Factory('collection/collections', client.Collection, control).enable_cache()
+		factory.find('a')
+		data = [{'name': 'n%d' % i} for i in range(8)]
+		report = bulk.run(factory.create, data, 8)
+		self.assertEqual(report.errors, [])
+		self.assertEqual(sorted(item.name() for item in report.results), [item['name'] for item in data])
+		self.assertEqual([factory.find(item['name']).name() for item in data], [item['name'] for item in data])
+
+
+@unittest.skipIf(aio is None, 'AsyncControl needs Python 3 and aiohttp')
+class AsyncFactoryCacheTest(unittest.TestCase):
+	def test_concurrent_creates_return_their_objects(self):
+		factory = aio.AsyncFactory('collection/collections', client.Collection, AsyncListingControl(delay=0.01)).enable_cache()
+		data = [{'name': 'n%d' % i} for i in range(8)]
+		loop = asyncio.new_event_loop()
+		try:
+			loop.run_until_complete(factory.find('a'))
+			report = loop.run_until_complete(aio.run(factory.create, data, 8))
+			found = [loop.run_until_complete(factory.find(item['name'])) for item in data]
+		finally:
+			loop.close()
+		self.assertEqual(report.errors, [])
+		self.assertEqual([item.name() for item in report.results], [item['name'] for item in data])
+		self.assertEqual([item.name() for item in found], [item['name'] for item in data])
+
+
+class InterruptedControl(client.Control):
+	'''
+	Control whose first read is interrupted after a follower joined it.
+	'''
+	def __init__(self):
+		client.Control.__init__(self, 'http://127.0.0.1:1/v1/', None, 'contract', transport=object(), coalesce=True)
+		self.started = threading.Event()
+		self.joined = threading.Event()
+		self.reads = 0
+
+	def _get(self, path, params=None):
+		self.reads += 1
+		if self.reads == 1:
+			self.started.set()
+			self.joined.wait(5)
+			raise KeyboardInterrupt()
+		return ['fresh']
+
+
+class CoalesceTest(unittest.TestCase):
+	def test_interrupted_leader_does_not_strand_followers(self):
+		control = InterruptedControl()
+		outcomes = []
+
+		def read():
+			try:
+				outcomes.append(control.get('collection/inputs'))
+			except BaseException as e:
+				outcomes.append(type(e).__name__)
+
+		leader = threading.Thread(target=read)
+		leader.daemon = True
+		leader.start()
+		control.started.wait(5)
+		follower = threading.Thread(target=read)
+		follower.daemon = True
+		follower.start()
+		while control.stats()['coalesced'] < 1:
+			follower.join(0.01)
+		control.joined.set()
+		leader.join(5)
+		follower.join(5)
+		self.assertFalse(follower.is_alive())
+		self.assertEqual(outcomes, ['KeyboardInterrupt', 'KeyboardInterrupt'])
+		self.assertEqual(control.get('collection/inputs'), ['fresh'])
+
+
+if __name__ == '__main__':
+	unittest.main()
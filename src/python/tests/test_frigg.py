@@ -0,0 +1,133 @@
+import threading
+import time
+import unittest
+
+from frigg.frigg import Frigg
+from frigg.store import MemoryTokenStore
+
+try:
+	import asyncio
+	from frigg.aio import AsyncFrigg, aiohttp
+except (ImportError, SyntaxError):
+	AsyncFrigg = aiohttp = None
+
+configuration = {
+	'clientId': 'client',
+	'clientSecret': 'secret',
+	'authServerDomain': 'http://127.0.0.1:1',
+	'backgroundRefresh': False
+}
+
+
+class CountingTokenStore(MemoryTokenStore):
+	def __init__(self):
+		MemoryTokenStore.__init__(self)
+		self.loads = 0
+
+	def load(self, key):
+		self.loads += 1
+		return MemoryTokenStore.load(self, key)
+
+
+class SlowInfoFrigg(Frigg):
+	'''
+	Auth server without expires_in whose token info request is slow, so
+	the token is known well before its expiry.
+	'''
+	def _token_post_request(self, payload):
+		self._stats['token_requests'] += 1
+		return {'access_token': 'access', 'refresh_token': 'refresh'}
+
+	def _request_token_info(self):
+		self._stats['info_requests'] += 1
+		time.sleep(0.2)
+		return {'ttl': 3600000}
+
+
+class StalledRefreshFrigg(Frigg):
+	'''
+	Auth server whose tokens expire at once and whose refresh requests
+	stall until released.
+	'''
+	def __init__(self, configuration):
+		Frigg.__init__(self, configuration)
+		self.refreshing = threading.Event()
+		self.release = threading.Event()
+
+	def _token_post_request(self, payload):
+		if payload['grant_type'] == 'refresh_token':
+			self.refreshing.set()
+			self.release.wait(5)
+		return {'access_token': 'access', 'refresh_token': 'refresh', 'expires_in': 0.1}
+
+
+class FriggTest(unittest.TestCase):
+	def test_concurrent_first_callers_wait_for_expiry(self):
+		store = CountingTokenStore()
+		frigg = SlowInfoFrigg(dict(configuration, tokenStore=store))
+		results = []
+		errors = []
+
+		def call():
+			try:
+				results.append(frigg.token())
+			except Exception as e:
+				errors.append(e)
+
+		threads = [threading.Thread(target=call) for i in range(8)]
+		threads[0].start()
+		time.sleep(0.05)
+		for thread in threads[1:]:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(errors, [])
+		self.assertEqual(results, ['access'] * 8)
+		self.assertEqual(frigg.stats()['token_requests'], 1)
+		# the callers queued behind the first find its token published
+		self.assertEqual(store.loads, 1)
+
+	def test_close_does_not_wait_for_a_running_refresh(self):
+		frigg = StalledRefreshFrigg(dict(configuration, backgroundRefresh=True, expirationOffset=0, refreshLead=0))
+		frigg.token()
+		self.assertTrue(frigg.refreshing.wait(5))
+		closing = threading.Thread(target=frigg.close)
+		closing.daemon = True
+		closing.start()
+		closing.join(1)
+		alive = closing.is_alive()
+		frigg.release.set()
+		self.assertFalse(alive)
+
+
+if AsyncFrigg is not None and aiohttp is not None:
+	class SlowInfoAsyncFrigg(AsyncFrigg):
+		def _token_post_request_async(self, payload):
+			self._stats['token_requests'] += 1
+			return asyncio.sleep(0, result={'access_token': 'access', 'refresh_token': 'refresh'})
+
+		def _request_token_info_async(self):
+			self._stats['info_requests'] += 1
+			return asyncio.sleep(0.2, result={'ttl': 3600000})
+
+
+@unittest.skipIf(AsyncFrigg is None or aiohttp is None, 'AsyncFrigg needs Python 3 and aiohttp')
+class AsyncFriggTest(unittest.TestCase):
+	def test_concurrent_first_callers_wait_for_expiry(self):
+		loop = asyncio.new_event_loop()
+		try:
+			store = CountingTokenStore()
+			frigg = SlowInfoAsyncFrigg(dict(configuration, tokenStore=store))
+			first = loop.create_task(frigg.token())
+			loop.run_until_complete(asyncio.sleep(0.05))
+			others = [frigg.token() for i in range(7)]
+			results = loop.run_until_complete(asyncio.gather(first, *others))
+		finally:
+			loop.close()
+		self.assertEqual(results, ['access'] * 8)
+		self.assertEqual(frigg.stats()['token_requests'], 1)
+		self.assertEqual(store.loads, 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
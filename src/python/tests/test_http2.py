@@ -0,0 +1,19 @@
+import unittest
+
+try:
+	import requests
+	from controlapi.http2 import httpx, request_params
+except (ImportError, SyntaxError):
+	httpx = None
+
+
+@unittest.skipIf(httpx is None, 'requires httpx')
+class RequestParamsTest(unittest.TestCase):
+	def test_query_matches_requests(self):
+		for params in [{'skip': 0, 'collectionId': None, 'active': True, 'deleted': False}, {'ids': ['a', None, 'b']}, {'name': None}, None]:
+			expected = requests.Request('GET', 'http://host/path', params=params).prepare().url
+			self.assertEqual(str(httpx.Request('GET', 'http://host/path', params=request_params(params)).url), expected)
+
+
+if __name__ == '__main__':
+	unittest.main()
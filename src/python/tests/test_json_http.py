@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+import controlapi.client as client
+import controlapi.json_http as http
+from bench.mock_server import MockServer
+from controlapi.cache import ResponseCache
+
+
+def chunked(data, size):
+	return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class CountingDecoder(json.JSONDecoder):
+	def __init__(self):
+		json.JSONDecoder.__init__(self)
+		self.calls = 0
+
+	def raw_decode(self, s, idx=0):
+		self.calls += 1
+		return json.JSONDecoder.raw_decode(self, s, idx)
+
+
+class JsonArrayParserTest(unittest.TestCase):
+	def parse(self, data, size):
+		parser = http.JsonArrayParser()
+		items = []
+		for chunk in chunked(data, size):
+			items.extend(parser.feed(chunk))
+		return items + parser.close()
+
+	def test_multibyte_characters_split_across_chunks(self):
+		value = [u'caf\xe9', {u'中': u'\U0001F600'}]
+		data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+		for size in (1, 2, 3):
+			self.assertEqual(self.parse(data, size), value)
+
+	def test_brackets_commas_and_escapes_in_strings(self):
+		value = [u'a]b', u'c,d', {u'e': u'}]\\"', u'f': [u'[', u'\\']}, u'\\\\"']
+		data = json.dumps(value).encode('utf-8')
+		for size in (1, 2, 5, len(data)):
+			self.assertEqual(self.parse(data, size), value)
+
+	def test_numbers_split_across_chunks(self):
+		value = [123456789, -1.25e10, 0, 987654321]
+		data = json.dumps(value).encode('utf-8')
+		for size in (1, 2, 3, 4, 7):
+			self.assertEqual(self.parse(data, size), value)
+
+	def test_large_element_is_decoded_once(self):
+		value = [{u'name': u'blocklist', u'entries': [u'entry %d, with ] and "' % i for i in range(20000)]}, 1]
+		data = json.dumps(value).encode('utf-8')
+		parser = http.JsonArrayParser()
+		parser._decoder = CountingDecoder()
+		items = []
+		chunks = chunked(data, 4096)
+		for chunk in chunks:
+			items.extend(parser.feed(chunk))
+		items.extend(parser.close())
+		self.assertEqual(items, value)
+		# one attempt where the element starts, one once it is complete, one for 1
+		self.assertEqual(parser._decoder.calls, 3)
+		self.assertTrue(len(chunks) > 100)
+
+	def test_empty_array_and_whitespace(self):
+		self.assertEqual(self.parse(b' [ ] ', 1), [])
+		self.assertEqual(self.parse(b'[\n  1 ,\n  [ 2 ] ,\n  "3"\n]', 2), [1, [2], u'3'])
+
+	def test_malformed_input(self):
+		for data in (b'{"a": 1}', b'[1', b'[1}', b'[{"a": 1]}', b'["abc'):
+			with self.assertRaises(ValueError):
+				self.parse(data, 1)
+
+
+class TokenControl(client.Control):
+	def token(self):
+		return 'token'
+
+
+class TransportCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.server = MockServer().start()
+		self.transport = http.Transport(cache=ResponseCache())
+		self.factory = TokenControl(self.server.url(), None, 'contract', self.transport).factory(client.FilterListFactory)
+
+	def tearDown(self):
+		self.transport.close()
+		self.server.stop()
+
+	def test_failed_write_drops_the_cached_listing(self):
+		self.factory.create('words', 'a')
+		filter_list = self.factory.list()[0]
+		api = self.server.api
+		handle = api.handle
+		api.handle = lambda method, path, headers, body: \
+			api.respond(0, 409, {'error': 'conflict'}) if method == 'PATCH' else handle(method, path, headers, body)
+		with self.assertRaises(http.HTTPError):
+			filter_list.add('rejected')
+		self.assertEqual(self.factory.list()[0].data['entries'], ['a'])
+		self.assertEqual(self.transport.cache.hits, 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
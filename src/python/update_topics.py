@@ -1,21 +1,33 @@
 import controlapi.client as client
+import controlapi.bulk as bulk
+import controlapi.reconcile as reconciliation
+import controlapi.sync as sync
+import controlapi.json_http as http
+import controlapi.metrics as metrics
+import controlapi.watch as watch
+from controlapi.cache import ResponseCache
 import logging
 import json
 
 logger = logging.getLogger(__name__)
 
-def get_control(contract_id, client_id, client_secret):
+auth_server = 'https://auth.crowdynews.com'
+
+def get_frigg(client_id, client_secret, token_store=None, auth_server=auth_server):
 	from frigg.frigg import Frigg
-	frigg = Frigg({
+	return Frigg({
 		"symbol":"EXT_CONTROCURATOR",
 		"clientId":client_id,
 		"clientSecret":client_secret,
-		"authServerDomain": "https://auth.crowdynews.com",
-		"authServerVersion": "v1"
+		"authServerDomain": auth_server,
+		"authServerVersion": "v1",
+		"tokenStore": token_store
 	})
-	contract_id = contract_id
 
-	control = client.Control('https://api.crowdynews.com/v1/', frigg, contract_id)
+def get_control(contract_id, client_id, client_secret, transport=None, token_store=None, instruments=None, base_url=client.base_url, auth_server=auth_server, frigg=None):
+	if frigg is None:
+		frigg = get_frigg(client_id, client_secret, token_store, auth_server)
+	control = client.Control(base_url, frigg, contract_id, transport, instruments)
 	return control
 
 def get_name(item):
@@ -27,7 +39,7 @@ def get_name(item):
 		return ' : '.join([item.path, '__no_name__', item.id()])
 
 def print_list(factory):
-	names = sorted([get_name(item) for item in factory.list()])
+	names = sorted(get_name(item) for item in factory.iter())
 	for name in names:
 		print name
 
@@ -36,51 +48,114 @@ def print_collection_inputs(collection, inputs):
 	for item in inputs:
 		print collection.name() + ':' + item.name()
 
-def get_input_uuid(item):
-	return ':'.join([item.data['collectionId'], item.name()])
-
-def input_names(collection_id,services,keywords):
-	return [
-		input_name(collection_id, service, services[service], keyword)
-		for keyword in keywords
-		for service in services
-	]
-
-def input_name(collection_id, service,type,q):
-	return ':'.join([collection_id,service,type,q])
-
 def filter_inputs(collection, inputs):
+	if isinstance(inputs, client.Snapshot):
+		return inputs.select('collectionId', collection.id())
 	return [item for item in inputs	if collection.id() == item.data['collectionId']]
 
-def remove_old_inputs(collection, inputs, services, keywords):
-	inputs = filter_inputs(collection, inputs)
-	names = input_names(collection.id(), services, keywords)
-	for item in inputs:
-		uuid = get_input_uuid(item)
-		if uuid not in names:
-			logger.warn('Deleting %s from %s' % (item.name(), collection.id()))
-			item.delete()
-
-def create_new_inputs(collection, inputs, services, keywords):
-	inputs = filter_inputs(collection, inputs)
-	names = [get_input_uuid(item) for item in inputs]
-	for keyword in keywords:
-		for service in services:
-			uuid = input_name(collection.id(), service, services[service], keyword)
-			if uuid not in names:
-				collection.add_input(service, services[service], keyword)
+def old_inputs(collection, inputs, services, keywords):
+	desired = reconciliation.desired_keys(services, keywords)
+	return reconciliation.plan_topic(collection.name(), desired, collection, filter_inputs(collection, inputs)).delete
+
+def new_inputs(collection, inputs, services, keywords):
+	desired = reconciliation.desired_keys(services, keywords)
+	return reconciliation.plan_topic(collection.name(), desired, collection, filter_inputs(collection, inputs)).create
+
+def remove_old_inputs(collection, inputs, services, keywords, concurrency=bulk.default_concurrency):
+	items = old_inputs(collection, inputs, services, keywords)
+	for item in items:
+		logger.warn('Deleting %s from %s' % (item.name(), collection.id()))
+	if isinstance(inputs, client.Snapshot):
+		return inputs.delete_many(items, concurrency=concurrency)
+	return client.InputFactory(collection.control).delete_many(items, concurrency=concurrency)
+
+def create_new_inputs(collection, inputs, services, keywords, concurrency=bulk.default_concurrency):
+	def create(spec):
+		item = collection.add_input(*spec)
+		if isinstance(inputs, client.Snapshot):
+			inputs.add(item)
+		return item
+	return bulk.run(create, new_inputs(collection, inputs, services, keywords), concurrency)
+
+def reconcile(collection, inputs, services, keywords, concurrency=bulk.default_concurrency):
+	"""
+	Applies the create/delete diff for one collection through a plan of
+	just its topic. When inputs is a Snapshot it is kept up to date with
+	the changes made.
+	"""
+	if not isinstance(inputs, client.Snapshot):
+		factory = client.InputFactory(collection.control)
+		inputs = client.Snapshot(factory, factory.index_fields, list(inputs))
+	desired = reconciliation.desired_keys(services, keywords)
+	topic = reconciliation.plan_topic(collection.name(), desired, collection, filter_inputs(collection, inputs))
+	result = reconciliation.Plan([topic]).execute(None, inputs, concurrency)
+	logger.warn('%s: %s' % (collection.name(), result.summary()))
+	return result.created, result.deleted
+
+def sync_topics(control, config, concurrency=bulk.default_concurrency, state_path=None, dry_run=False):
+	'''
+	Reconciles the collections and inputs of control's contract with a
+	topics configuration, incrementally when a state file is given.
+	Returns the plan, its result (None on a dry run) and the collections
+	and inputs snapshots.
+	'''
+	collections = client.CollectionFactory(control).snapshot()
+	cif = client.InputFactory(control)
+	if state_path:
+		state = sync.SyncState(state_path)
+		plan, inputs = sync.plan(config, state, collections, cif)
+	else:
+		inputs = cif.snapshot()
+		plan = reconciliation.plan(config, collections, inputs)
+	if dry_run:
+		return plan, None, collections, inputs
+	result = plan.execute(collections, inputs, concurrency)
+	logger.warn(result.summary())
+	if state_path:
+		sync.record(plan, result, state)
+		state.save()
+	return plan, result, collections, inputs
 
 if __name__ == "__main__":
 	import argparse
+	import atexit
+	import signal
+	import sys
 
 	parser = argparse.ArgumentParser(description='Update topics.')
 	parser.add_argument('contract_id', help='The contract identifier')
 	parser.add_argument('client_id', help='The auth client identifier')
 	parser.add_argument('client_secret', help='The auth client secret')
 	parser.add_argument('topics_file', help='The configuration file')
+	parser.add_argument('--concurrency', type=int, default=bulk.default_concurrency, help='Maximum number of concurrent API calls')
+	parser.add_argument('--token-store', help='File to share access tokens between runs')
+	parser.add_argument('--dry-run', action='store_true', help='Print the changes without making them')
+	parser.add_argument('--state', help='State file for incremental syncs; only changed topics are reconciled')
+	parser.add_argument('--metrics', help='Write request metrics in the Prometheus text format to this file')
+	parser.add_argument('--trace', help='Append the request spans as JSON lines to this file')
+	parser.add_argument('--watch', action='store_true', help='Keep running and apply changes to the topics file as they are made')
+	parser.add_argument('--drift-interval', type=float, default=300, help='Seconds between checks of the API for remote changes in watch mode')
 
 	args = parser.parse_args()
-	control = get_control(args.contract_id, args.client_id, args.client_secret)
+	instruments = None
+	if args.metrics or args.trace:
+		instruments = metrics.Instruments(metrics.Metrics() if args.metrics else None)
+		if args.trace:
+			instruments.add_hook(metrics.JsonSpanExporter(args.trace))
+		if args.metrics:
+			atexit.register(instruments.metrics.write, args.metrics)
+	# in watch mode unchanged listings are revalidated with ETags on drift checks
+	transport = http.Transport(pool_maxsize=max(args.concurrency, 1), cache=ResponseCache() if args.watch else None)
+	control = get_control(args.contract_id, args.client_id, args.client_secret, transport, args.token_store, instruments)
+
+	if args.watch:
+		daemon = watch.TopicsDaemon(control, args.topics_file, args.concurrency, args.drift_interval, state_path=args.state)
+		signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+		try:
+			daemon.run_forever()
+		except KeyboardInterrupt:
+			pass
+		sys.exit(0)
 
 	ccf = client.CollectionFactory(control)
 	cif = client.InputFactory(control)
@@ -95,17 +170,14 @@ if __name__ == "__main__":
 	with open(args.topics_file) as f:
 		config = json.load(f)
 
-	topics = config['topics']
-	services = config['services']
-	for topic in topics:
-		collection = ccf.find(topic)
-		if not collection:
-			collection = ccf.create(topic)
-		keywords = topics[topic]
-		remove_old_inputs(collection, cif.list(), services, keywords)
-		create_new_inputs(collection, cif.list(), services, keywords)
-
-	print_list(cif)
-	for collection in ccf.list():
-		print_collection_inputs(collection, cif.list())
+	plan, result, collections, inputs = sync_topics(control, config, args.concurrency, args.state, args.dry_run)
+	if args.dry_run:
+		print plan.dry_run()
+		sys.exit(0)
+	if args.state:
+		sys.exit(0)
+
+	print_list(inputs)
+	for collection in collections.list():
+		print_collection_inputs(collection, inputs)
 		print collection.data['contentUri']